@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015, Ralf Jung <post@ralfj.de>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer. 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+
+# This benchmarks git-mirror: It builds a synthetic repository, wires it up to a number of local bare repositories as
+# mirrors, and measures how long it takes for pushes (via githook.py) and GitHub-style webhook deliveries (via
+# webhook-core.py) to propagate to all mirrors. The results are written as JSON, so that they can be compared between
+# versions of git-mirror.
+import argparse, tempfile, shutil, json, time, resource, statistics, hmac, hashlib, random, threading
+import os, sys, subprocess
+
+git_mirror_dir = os.path.dirname(os.path.abspath(__file__))
+
+class Bench:
+    def __init__(self, dir, args):
+        self.dir = dir
+        self.args = args
+        self.config_file = os.path.join(dir, 'git-mirror.conf')
+        self.env = dict(os.environ, GIT_MIRROR_CONFIG = self.config_file,
+                        GIT_AUTHOR_NAME = 'bench', GIT_AUTHOR_EMAIL = 'bench@localhost',
+                        GIT_COMMITTER_NAME = 'bench', GIT_COMMITTER_EMAIL = 'bench@localhost')
+        # count how many git processes get started: with trace2 writing to a directory, every one of them creates a file there
+        self.trace_dir = os.path.join(dir, 'trace2')
+        os.mkdir(self.trace_dir)
+        self.traced_env = dict(self.env, GIT_TRACE2_EVENT = self.trace_dir)
+        self.repos = None
+    
+    def run(self, *cmd, cwd = None, input = None, traced = False):
+        '''Run <cmd>; if <traced>, count the git processes it starts.'''
+        return subprocess.run(cmd, cwd = cwd or self.dir, env = self.traced_env if traced else self.env, input = input, check = True,
+                              stdout = subprocess.PIPE, stderr = subprocess.STDOUT).stdout.decode('utf-8')
+    
+    def spawns(self):
+        return len(os.listdir(self.trace_dir))
+    
+    def make_history(self, work):
+        '''Create the synthetic history in <work> using fast-import.'''
+        rnd = random.Random(42)
+        stream = []
+        for i in range(self.args.commits):
+            data = rnd.getrandbits(8*1024*self.args.file_size).to_bytes(1024*self.args.file_size, 'little') if self.args.file_size else b''
+            msg = "commit {}".format(i).encode('utf-8')
+            stream.append(b"commit refs/heads/master\nmark :%d\ncommitter bench <bench@localhost> %d +0000\ndata %d\n%s\n"
+                          % (i+1, 1500000000+i, len(msg), msg))
+            stream.append(b"M 644 inline file%d\ndata %d\n%s\n" % (i % 100, len(data), data))
+        for i in range(self.args.branches):
+            stream.append(b"reset refs/heads/branch-%d\nfrom :%d\n\n" % (i, rnd.randint(1, self.args.commits)))
+        for i in range(self.args.tags):
+            stream.append(b"reset refs/tags/tag-%d\nfrom :%d\n\n" % (i, rnd.randint(1, self.args.commits)))
+        self.run('git', 'fast-import', '--quiet', cwd = work, input = b''.join(stream))
+        self.run('git', 'checkout', '-q', '-f', 'master', cwd = work)
+    
+    def setup(self):
+        self.source = os.path.join(self.dir, 'source.git')
+        self.mirrors = [os.path.join(self.dir, 'mirror{}.git'.format(i)) for i in range(self.args.mirrors)]
+        for repo in [self.source] + self.mirrors:
+            self.run('git', 'init', '-q', '--bare', repo)
+        hook = os.path.join(self.source, 'hooks', 'post-receive')
+        with open(hook, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}"\n'.format(os.path.join(git_mirror_dir, 'githook.py')))
+        os.chmod(hook, 0o755)
+        self.secret = 'benchmark-secret'
+        with open(self.config_file, 'w') as f:
+            f.write("mail-sender = bench@localhost\nstate-dir = {}\n".format(os.path.join(self.dir, 'state')))
+            for line in self.args.option or []:
+                f.write(line+"\n")
+            f.write("\n[bench]\nowner = bench@localhost\nlocal = {}\ndeploy-key = none\nhmac-secret = {}\n".format(self.source, self.secret))
+            for (i, mirror) in enumerate(self.mirrors):
+                f.write("mirror-{} = {}\n".format(i, mirror))
+        self.work = os.path.join(self.dir, 'work')
+        self.run('git', 'init', '-q', self.work)
+        self.make_history(self.work)
+        self.run('git', 'remote', 'add', 'origin', self.source, cwd = self.work)
+    
+    def check_mirrors(self, ref, sha, mirrors = None):
+        for mirror in mirrors or self.mirrors:
+            actual = self.run('git', 'rev-parse', '--verify', '-q', ref, cwd = mirror).strip()
+            if actual != sha:
+                raise Exception("Mirror {} has {} at {}, expected {}".format(mirror, ref, actual, sha))
+    
+    def measure(self, fn, count):
+        '''Run fn(i) <count> times, and return the statistics. Only the time of fn is measured, so it must do the
+           operation and wait for it to propagate to all mirrors.'''
+        spawns = self.spawns()
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            fn(i)
+            latencies.append(time.perf_counter() - start)
+        return self.stats(latencies, self.spawns() - spawns)
+    
+    @staticmethod
+    def stats(latencies, spawns):
+        latencies = sorted(latencies)
+        return {
+            'count': len(latencies),
+            'latency_min': latencies[0],
+            'latency_median': statistics.median(latencies),
+            'latency_p95': latencies[min(len(latencies)-1, int(0.95*len(latencies)))],
+            'latency_max': latencies[-1],
+            'git_spawns_per_op': spawns / len(latencies),
+            'max_child_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+    
+    def commit(self, work, branch):
+        self.run('git', 'commit', '-q', '--allow-empty', '-m', 'bench', cwd = work)
+        return self.run('git', 'rev-parse', 'HEAD', cwd = work).strip()
+    
+    def bench_initial(self):
+        '''Push all branches and tags at once.'''
+        def push(i):
+            self.run('git', 'push', '-q', 'origin', '--all', cwd = self.work, traced = True)
+            self.run('git', 'push', '-q', 'origin', '--tags', cwd = self.work, traced = True)
+        result = self.measure(push, 1)
+        self.check_mirrors('refs/heads/master', self.run('git', 'rev-parse', 'master', cwd = self.work).strip())
+        result['refs'] = 1 + self.args.branches + self.args.tags
+        return result
+    
+    def bench_hook(self):
+        '''Push single commits to master, one after the other.'''
+        def push(i):
+            sha = self.commit(self.work, 'master')
+            self.run('git', 'push', '-q', 'origin', 'master', cwd = self.work, traced = True)
+            self.check_mirrors('refs/heads/master', sha)
+        return self.measure(push, self.args.rounds)
+    
+    def bench_concurrent(self):
+        '''Push to different branches from several clones at the same time.'''
+        clones = []
+        for i in range(self.args.concurrency):
+            clone = os.path.join(self.dir, 'clone{}'.format(i))
+            self.run('git', 'clone', '-q', self.source, clone)
+            self.run('git', 'checkout', '-q', '-b', 'concurrent-{}'.format(i), cwd = clone)
+            clones.append(clone)
+        latencies = []
+        errors = []
+        def worker(i):
+            try:
+                for round in range(self.args.rounds):
+                    sha = self.commit(clones[i], 'concurrent-{}'.format(i))
+                    start = time.perf_counter()
+                    self.run('git', 'push', '-q', 'origin', 'concurrent-{}'.format(i), cwd = clones[i], traced = True)
+                    latencies.append(time.perf_counter() - start)
+                self.check_mirrors('refs/heads/concurrent-{}'.format(i), sha)
+            except Exception as e:
+                errors.append(e)
+        spawns = self.spawns()
+        start = time.perf_counter()
+        threads = [threading.Thread(target = worker, args = (i,)) for i in range(self.args.concurrency)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        duration = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+        result = self.stats(latencies, self.spawns() - spawns)
+        result['throughput_pushes_per_second'] = len(latencies) / duration
+        return result
+    
+    def bench_webhook(self):
+        '''Update the first mirror directly (like a push to GitHub), and deliver a signed webhook payload for that.'''
+        github = self.mirrors[0]
+        def deliver(i):
+            old = self.run('git', 'rev-parse', 'master', cwd = self.work).strip()
+            new = self.commit(self.work, 'master')
+            self.run('git', 'push', '-q', github, 'master', cwd = self.work)
+            payload = json.dumps({ 'ref': 'refs/heads/master', 'before': old, 'after': new,
+                                   'repository': { 'git_url': github, 'ssh_url': github, 'clone_url': github } }).encode('utf-8')
+            signature = "sha1="+hmac.new(self.secret.encode('utf-8'), payload, hashlib.sha1).hexdigest()
+            out = self.run(os.path.join(git_mirror_dir, 'webhook-core.py'), 'bench', 'push', signature, input = payload, traced = True)
+            if 'Status: 500' in out:
+                raise Exception(out)
+            self.check_mirrors('refs/heads/master', new)
+        return self.measure(deliver, self.args.rounds)
+    
+    def bench_startup(self):
+        '''Load the configuration with many repositories, and find one of them (like githook.py does).'''
+        config_file = os.path.join(self.dir, 'startup.conf')
+        with open(config_file, 'w') as f:
+            f.write("mail-sender = bench@localhost\n")
+            for i in range(self.args.startup_repos):
+                f.write("\n[repo{0}]\nowner = bench@localhost\nlocal = /srv/repo{0}.git\ndeploy-key = key{0}\n"
+                        "mirror-a = git@a.example.com:repo{0}.git\nmirror-b = git@b.example.com:repo{0}.git\n".format(i))
+        code = "from git_mirror import *; assert load_repo_by_directory('/srv/repo{}.git') is not None".format(self.args.startup_repos-1)
+        env = dict(self.env, GIT_MIRROR_CONFIG = config_file, PYTHONPATH = git_mirror_dir)
+        def start(i):
+            subprocess.run([sys.executable, '-c', code], env = env, check = True)
+        start(0) # build the snapshot
+        return self.measure(start, self.args.rounds)
+
+    def setup_repos(self):
+        '''Set up many repositories (cloned from the source), each with its own mirrors, and wait until all mirrors have the
+           history. Return a list of triples (name, local, mirrors).'''
+        if self.repos is not None:
+            return self.repos
+        self.repos = []
+        with open(self.config_file, 'a') as f:
+            for i in range(self.args.repos):
+                name = 'repo{}'.format(i)
+                local = os.path.join(self.dir, name+'.git')
+                mirrors = [os.path.join(self.dir, '{}-mirror{}.git'.format(name, j)) for j in range(self.args.mirrors)]
+                self.run('git', 'clone', '-q', '--bare', self.source, local)
+                shutil.copy(os.path.join(self.source, 'hooks', 'post-receive'), os.path.join(local, 'hooks', 'post-receive'))
+                for mirror in mirrors:
+                    self.run('git', 'init', '-q', '--bare', mirror)
+                f.write("\n[{}]\nowner = bench@localhost\nlocal = {}\ndeploy-key = none\n".format(name, local))
+                for (j, mirror) in enumerate(mirrors):
+                    f.write("mirror-{} = {}\n".format(j, mirror))
+                self.repos.append((name, local, mirrors))
+        self.run(*self.reconcile())
+        return self.repos
+    
+    def reconcile(self):
+        return [os.path.join(git_mirror_dir, 'reconcile.py'), '-j', str(len(self.repos))] + [name for (name, local, mirrors) in self.repos]
+    
+    def bench_repos(self):
+        '''Sync many repositories at the same time in one process, by reconciling all of them with their own mirrors.'''
+        repos = self.setup_repos()
+        reconcile = self.reconcile()
+        def sync(i):
+            # give every repository a different new commit, so that mixing them up would be noticed
+            shas = []
+            for (name, local, mirrors) in repos:
+                tree = self.run('git', 'rev-parse', 'master^{tree}', cwd = local).strip()
+                sha = self.run('git', 'commit-tree', tree, '-p', 'master', '-m', '{} {}'.format(name, i), cwd = local).strip()
+                self.run('git', 'update-ref', 'refs/heads/master', sha, cwd = local)
+                shas.append(sha)
+            self.run(*reconcile, traced = True)
+            for ((name, local, mirrors), sha) in zip(repos, shas):
+                self.check_mirrors('refs/heads/master', sha, mirrors)
+        result = self.measure(sync, self.args.rounds)
+        result['repos'] = len(repos)
+        return result
+    
+    def bench_repos_webhook(self):
+        '''Deliver webhooks for many repositories at the same time to the threads of one process, like webhook-server.py
+           does. Every repository gets its own commit from a different mirror, so if the state of the git commands (like
+           GIT_MIRROR_SOURCE, telling the hook which mirror to skip) got mixed up between the threads, some mirror would
+           end up with the wrong commit, or none.'''
+        repos = self.setup_repos()
+        def deliver(i):
+            deliveries = []
+            for (k, (name, local, mirrors)) in enumerate(repos):
+                github = mirrors[k % len(mirrors)]
+                old = self.run('git', 'rev-parse', 'master', cwd = github).strip()
+                tree = self.run('git', 'rev-parse', 'master^{tree}', cwd = github).strip()
+                new = self.run('git', 'commit-tree', tree, '-p', old, '-m', '{} webhook {}'.format(name, i), cwd = github).strip()
+                self.run('git', 'update-ref', 'refs/heads/master', new, old, cwd = github)
+                payload = { 'ref': 'refs/heads/master', 'before': old, 'after': new,
+                            'repository': { 'git_url': github, 'ssh_url': github, 'clone_url': github } }
+                deliveries.append((name, payload))
+            # python puts the current directory into the path, that is how the driver finds git_mirror
+            self.run(sys.executable, '-c', webhook_driver, cwd = git_mirror_dir, input = json.dumps(deliveries).encode('utf-8'),
+                     traced = True)
+            for ((name, local, mirrors), (_, payload)) in zip(repos, deliveries):
+                self.check_mirrors('refs/heads/master', payload['after'], [local] + mirrors)
+        result = self.measure(deliver, self.args.rounds)
+        result['repos'] = len(repos)
+        return result
+
+# handles the deliveries (pairs of a repository name and a payload) given on stdin concurrently
+webhook_driver = '''
+import concurrent.futures
+from git_mirror import *
+deliveries = json.load(sys.stdin)
+repos = load_repos()
+with concurrent.futures.ThreadPoolExecutor(max_workers = len(deliveries)) as pool:
+    list(pool.map(lambda delivery: repos[delivery[0]].update_from_github_push(delivery[1]), deliveries))
+assert 'GIT_MIRROR_SOURCE' not in os.environ, "GIT_MIRROR_SOURCE leaked into the environment of the process"
+'''
+
+scenarios = ['initial', 'hook', 'concurrent', 'webhook', 'startup', 'repos', 'repos-webhook']
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark git-mirror with local repositories')
+    parser.add_argument("--commits", type=int, default=200, help="Number of commits in the synthetic history")
+    parser.add_argument("--branches", type=int, default=20, help="Number of branches")
+    parser.add_argument("--tags", type=int, default=50, help="Number of tags")
+    parser.add_argument("--file-size", dest="file_size", type=int, default=4, help="KiB of random data changed per commit")
+    parser.add_argument("--mirrors", type=int, default=4, help="Number of mirrors")
+    parser.add_argument("--rounds", type=int, default=10, help="How often to repeat each measurement")
+    parser.add_argument("--concurrency", type=int, default=4, help="How many clones push at the same time")
+    parser.add_argument("--repos", type=int, default=8, help="How many repositories to sync at the same time")
+    parser.add_argument("--startup-repos", dest="startup_repos", type=int, default=1000,
+                        help="How many repositories to configure for the start-up benchmark")
+    parser.add_argument("--option", action="append",
+                        help="Add this line to the top part of the git-mirror configuration (can be given several times)")
+    parser.add_argument("--scenario", action="append", choices=scenarios,
+                        help="Only run this scenario (can be given several times)")
+    parser.add_argument("-o", "--output", dest="output", default="-", help="Where to write the JSON results (default: stdout)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory")
+    args = parser.parse_args()
+    
+    dir = tempfile.mkdtemp(prefix = 'git-mirror-bench-')
+    try:
+        bench = Bench(dir, args)
+        bench.setup()
+        version = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd = git_mirror_dir, stdout = subprocess.PIPE,
+                                 stderr = subprocess.DEVNULL).stdout.decode('utf-8').strip()
+        results = { 'git_mirror_version': version, 'time': time.time(), 'parameters': vars(args), 'results': {} }
+        for scenario in args.scenario or scenarios:
+            if scenario not in ('initial', 'startup') and 'initial' not in results['results']:
+                results['results']['initial'] = bench.bench_initial() # the mirrors need the history first
+            results['results'][scenario] = getattr(bench, 'bench_'+scenario.replace('-', '_'))()
+            sys.stderr.write("{}: {}\n".format(scenario, json.dumps(results['results'][scenario])))
+        output = json.dumps(results, indent = 2, sort_keys = True)+"\n"
+        if args.output == '-':
+            sys.stdout.write(output)
+        else:
+            with open(args.output, 'w') as f:
+                f.write(output)
+    finally:
+        if args.keep:
+            sys.stderr.write("Kept {}\n".format(dir))
+        else:
+            shutil.rmtree(dir)
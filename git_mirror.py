@@ -21,13 +21,18 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #==============================================================================
-import sys, os, os.path, subprocess
-import configparser, itertools, re
-import hmac, hashlib
-import email.mime.text, email.utils, smtplib
+# Only modules needed by every hook are imported here; the others (mail, HMAC, configparser, ...) are imported
+# by the functions that need them, to keep the start-up time of the hooks low.
+import sys, os, os.path, subprocess, time
+import re, json, contextlib
 
 mail_sender = "null@localhost"
-config_file = os.path.join(os.path.dirname(__file__), 'git-mirror.conf')
+mail_smtp = "localhost" # host[:port] of the SMTP server
+mail_spool = False # whether to hand mails to mail-sender.py instead of sending them right away
+mail_dedup_window = 3600 # how many seconds to wait before mailing the same error again
+state_dir = os.path.join(os.path.dirname(__file__), 'state') # where to keep persistent state, like the job queue
+use_queue = False # whether the hooks should just queue their work
+config_file = os.getenv('GIT_MIRROR_CONFIG', os.path.join(os.path.dirname(__file__), 'git-mirror.conf'))
 
 def Popen_quirky(cmd, **args):
     '''
@@ -41,14 +46,27 @@ def Popen_quirky(cmd, **args):
         return subprocess.Popen(['/bin/sh'] + cmd, **args)
 
 class GitCommand:
+    '''Runs git commands in the directory <cwd> with the environment <env> (default: those of this process).'''
+    def __init__(self, cwd = None, env = None):
+        self.cwd = cwd
+        self.env = env
+    
     def __getattr__(self, name):
-        def call(*args, capture_stderr = False, check = True):
+        def call(*args, capture_stderr = False, check = True, timeout = None, input = None):
             '''If <capture_stderr>, return stderr merged with stdout. Otherwise, return stdout and forward stderr to our own.
                If <check> is true, throw an exception of the process fails with non-zero exit code. Otherwise, do not.
+               If <timeout> is given, kill the process and throw an exception if it takes longer than that many seconds.
+               If <input> is given, send it to the process on stdin.
                In any case, return a pair of the captured output and the exit code.'''
             cmd = ["git", name.replace('_', '-')] + list(args)
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT if capture_stderr else sys.stderr) as p:
-                (stdout, stderr) = p.communicate()
+            with subprocess.Popen(cmd, cwd=self.cwd, env=self.env, stdin=None if input is None else subprocess.PIPE, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT if capture_stderr else sys.stderr) as p:
+                try:
+                    (stdout, stderr) = p.communicate(None if input is None else input.encode('utf-8'), timeout = timeout)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+                    p.communicate()
+                    raise Exception("Error running {}: Timed out after {} seconds".format(cmd, timeout))
                 assert stderr is None
                 code = p.returncode
                 if check and code:
@@ -56,26 +74,309 @@ class GitCommand:
             return (stdout.decode('utf-8').strip('\n'), code)
         return call
 
-git = GitCommand()
+class GitLines:
+    '''The output of a git command, to be iterated over line by line while the command is still running. Besides newlines,
+       carriage returns (as used by progress output) also end a line; empty lines are skipped. After the iteration is
+       complete, <returncode> is the exit code of the command. Stopping the iteration early kills the command.'''
+    def __init__(self, cmd, cwd, env, capture_stderr, check, timeout, input):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.capture_stderr = capture_stderr
+        self.check = check
+        self.timeout = timeout
+        self.input = input
+        self.returncode = None
+    
+    def __iter__(self):
+        import threading
+        p = subprocess.Popen(self.cmd, cwd=self.cwd, env=self.env, stdin=None if self.input is None else subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT if self.capture_stderr else sys.stderr)
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            p.kill()
+        timer = None if self.timeout is None else threading.Timer(self.timeout, kill)
+        try:
+            if self.input is not None:
+                # write from another thread, so that git cannot block us by not reading while we are not reading either
+                def write():
+                    with p.stdin:
+                        p.stdin.write(self.input.encode('utf-8'))
+                threading.Thread(target = write, daemon = True).start()
+            if timer is not None:
+                timer.start()
+            # only keep one chunk of output in memory at a time
+            rest = b''
+            while True:
+                chunk = p.stdout.read1(64*1024)
+                if not chunk:
+                    break
+                lines = re.split(b'[\r\n]', rest + chunk)
+                rest = lines.pop()
+                for line in lines:
+                    if line:
+                        yield line.decode('utf-8')
+            if rest:
+                yield rest.decode('utf-8')
+            self.returncode = p.wait()
+        finally:
+            if p.poll() is None:
+                p.kill()
+            if timer is not None:
+                timer.cancel()
+            p.stdout.close()
+            p.wait()
+        if timed_out:
+            raise Exception("Error running {}: Timed out after {} seconds".format(self.cmd, self.timeout))
+        if self.check and self.returncode:
+            raise Exception("Error running {}: Non-zero exit code".format(self.cmd))
+
+class GitStream(GitCommand):
+    '''Like GitCommand, but return a GitLines to go over the output while the command is running, so that huge outputs do
+       not have to be kept in memory all at once.'''
+    def __getattr__(self, name):
+        def call(*args, capture_stderr = False, check = True, timeout = None, input = None):
+            return GitLines(["git", name.replace('_', '-')] + list(args), self.cwd, self.env, capture_stderr, check, timeout, input)
+        return call
+
 git_nullsha = 40*"0"
+seed_ref = "refs/git-mirror/seed" # where Repo.seed puts the history while it is not complete yet
 
-def git_is_forced_update(oldsha, newsha):
+def git_is_forced_update(git, oldsha, newsha):
+    '''Tell whether updating from <oldsha> to <newsha> is a forced update, using the GitCommand <git>.'''
     out, code = git.merge_base("--is-ancestor", oldsha, newsha, check = False) # "Check if the first <commit> is an ancestor of the second <commit>"
     assert not out
     assert code in (0, 1)
     return False if code == 0 else True # if oldsha is an ancestor of newsha, then this was a "good" (non-forced) update
 
+def git_forced_updates(git, pairs):
+    '''For a list of (oldsha, newsha) pairs of commits, return the list of whether updating from oldsha to newsha is a forced
+       update, like git_is_forced_update does, but using a single rev-list for all of them. This walks the history from all the
+       new commits, stopping at the parents of the old ones; if oldsha is an ancestor of newsha, then it is reachable from
+       newsha in that part of the history. Pairs that cannot be decided that way are checked individually.'''
+    if not pairs:
+        return []
+    revs = ''.join("{}\n^{}^@\n".format(newsha, oldsha) for (oldsha, newsha) in pairs)
+    out, code = git.rev_list('--parents', '--stdin', input = revs, check = False)
+    if code:
+        return [git_is_forced_update(git, oldsha, newsha) for (oldsha, newsha) in pairs]
+    parents = {}
+    for line in out.split('\n'):
+        line = line.split()
+        if line:
+            parents[line[0]] = line[1:]
+    result = []
+    for (oldsha, newsha) in pairs:
+        if oldsha == newsha:
+            result.append(False)
+        elif oldsha not in parents or newsha not in parents:
+            # the history walk does not tell us (e.g., these are tags, or oldsha is an ancestor of another old commit)
+            result.append(git_is_forced_update(git, oldsha, newsha))
+        else:
+            # search oldsha in the part of the history of newsha that we got
+            seen = set([newsha])
+            todo = [newsha]
+            while todo and oldsha not in seen:
+                for parent in parents.get(todo.pop(), []):
+                    if parent not in seen:
+                        seen.add(parent)
+                        todo.append(parent)
+            result.append(oldsha not in seen)
+    return result
+
+class GitBackend:
+    '''Queries and updates of the refs of a repository, running one git command for each of them using the GitCommand <git>.'''
+    def __init__(self, git):
+        self.git = git
+    
+    def resolve_refs(self, refs):
+        '''Return a dict mapping each of the given (full) <refs> to its SHA, or the null SHA if it does not exist.'''
+        result = {}
+        for ref in refs:
+            state, code = self.git.show_ref(ref, check = False)
+            if code == 0:
+                result[ref] = state.split()[0]
+            else:
+                if len(state):
+                    raise Exception("Something went wrong getting the local state of {}.".format(ref))
+                result[ref] = git_nullsha
+        return result
+    
+    def update_refs(self, updates):
+        '''Apply the given (ref, newsha, oldsha) updates, checking that each ref still is at its oldsha. A newsha of null
+           deletes the ref.'''
+        for (ref, newsha, oldsha) in updates:
+            if newsha == git_nullsha:
+                self.git.update_ref("-d", ref, oldsha) # this checks that the old value is still oldsha
+            else:
+                self.git.update_ref(ref, newsha, oldsha)
+    
+    def forced_updates(self, pairs):
+        '''For a list of (oldsha, newsha) pairs of commits, return the list of whether they are forced updates.'''
+        return [git_is_forced_update(self.git, oldsha, newsha) for (oldsha, newsha) in pairs]
+    
+    def close(self):
+        pass
+
+class BatchGitBackend(GitBackend):
+    '''Queries and updates of the refs of the repository the GitCommand <git> works in, using long-lived "git cat-file
+       --batch-check" and "git update-ref --stdin" processes. Several ref updates are applied as one atomic transaction, and
+       ancestry checks for many refs are done with a single rev-list.'''
+    def __init__(self, git):
+        import threading
+        super().__init__(git)
+        self.local = git.cwd
+        self.lock = threading.Lock()
+        self.cat_file = None
+        self.update_ref = None
+    
+    def start(self, args, stderr):
+        return subprocess.Popen(["git"]+args, cwd = self.local, env = self.git.env, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                stderr = stderr, universal_newlines = True, bufsize = 1)
+    
+    def resolve_refs(self, refs):
+        with self.lock:
+            if self.cat_file is None or self.cat_file.poll() is not None:
+                self.cat_file = self.start(["cat-file", "--batch-check"], sys.stderr)
+            result = {}
+            # send one ref, read one answer; that way, the pipes never fill up
+            for ref in refs:
+                assert ref.startswith('refs/') and not any(c.isspace() for c in ref), "Invalid ref name {}".format(ref)
+                self.cat_file.stdin.write(ref+"\n")
+                self.cat_file.stdin.flush()
+                answer = self.cat_file.stdout.readline().split()
+                if not answer:
+                    raise Exception("git cat-file died while resolving {}.".format(ref))
+                result[ref] = git_nullsha if answer[-1] == 'missing' else answer[0]
+            return result
+    
+    def transaction_command(self, command):
+        '''Send <command> to update-ref and check that it got acknowledged.'''
+        self.update_ref.stdin.write(command+"\n")
+        self.update_ref.stdin.flush()
+        if self.update_ref.stdout.readline() != command+": ok\n":
+            raise OSError("update-ref did not acknowledge {}".format(command))
+    
+    def update_refs(self, updates):
+        with self.lock:
+            if self.update_ref is None or self.update_ref.poll() is not None:
+                self.update_ref = self.start(["update-ref", "--stdin"], subprocess.PIPE)
+            try:
+                self.transaction_command("start")
+                for (ref, newsha, oldsha) in updates:
+                    if newsha == git_nullsha:
+                        self.update_ref.stdin.write("delete {} {}\n".format(ref, oldsha))
+                    else:
+                        self.update_ref.stdin.write("update {} {} {}\n".format(ref, newsha, oldsha))
+                # this locks all the refs and checks their old values, then we apply all the changes
+                self.transaction_command("prepare")
+                self.transaction_command("commit")
+            except OSError:
+                # update-ref dies when the transaction fails; tell the user why
+                (p, self.update_ref) = (self.update_ref, None)
+                (stdout, stderr) = p.communicate()
+                raise Exception("Error updating refs in {}:\n{}".format(self.local, stderr.strip('\n')))
+    
+    def forced_updates(self, pairs):
+        return git_forced_updates(self.git, pairs)
+    
+    def close(self):
+        with self.lock:
+            for p in (self.cat_file, self.update_ref):
+                if p is not None and p.poll() is None:
+                    p.stdin.close()
+                    p.wait()
+            self.cat_file = None
+            self.update_ref = None
+
+def ssh_destination(url):
+    '''Return a pair of the SSH destination ([user@]host) and port (or None) that git uses for <url>, or None if <url> does
+       not use SSH.'''
+    m = re.match(r'(?:ssh|git\+ssh|ssh\+git)://([^/:]+)(?::([0-9]+))?/', url)
+    if m is not None:
+        return (m.group(1), m.group(2))
+    m = re.match(r'([^/:]+):', url) # scp-like syntax; the colon must come before the first slash
+    if m is not None and '://' not in url:
+        return (m.group(1), None)
+    return None
+
+def make_private_dir(path):
+    '''Create the directory <path> if needed, and make sure that only we have access to it.'''
+    import stat
+    os.makedirs(path, mode = 0o700, exist_ok = True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise Exception("{} must be a directory owned by us, and not accessible by anybody else.".format(path))
+
+def ssh_control_check(ssh_command, control_path, command = 'check'):
+    '''Send <command> ("check" or "exit") to the SSH master listening on the socket <control_path>. Return whether that succeeded.'''
+    return subprocess.call([ssh_command, '-o', 'ControlPath='+control_path, '-O', command, 'git-mirror'],
+                           stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) == 0
+
+def ssh_control_sockets(control_dir):
+    '''Return the paths of all the SSH master sockets in <control_dir> (which contains one directory per deploy key).'''
+    sockets = []
+    if os.path.isdir(control_dir):
+        for key_dir in sorted(os.listdir(control_dir)):
+            key_dir = os.path.join(control_dir, key_dir)
+            if os.path.isdir(key_dir):
+                sockets.extend(os.path.join(key_dir, socket) for socket in sorted(os.listdir(key_dir)))
+    return sockets
+
+def git_refs(lines):
+    '''Parse the output <lines> of show-ref or ls-remote, yielding (sha, ref) pairs. Peeled tags are ignored.'''
+    for line in lines:
+        line = line.split()
+        if len(line) == 0 or line[1].endswith('^{}'): continue
+        yield (line[0], line[1])
+
+def git_parse_refs(lines):
+    '''Parse the output <lines> of show-ref or ls-remote into a dict mapping refs to SHAs. Peeled tags are ignored.'''
+    return dict((ref, sha) for (sha, ref) in git_refs(lines))
+
+def git_progress(lines):
+    '''Go over the output <lines> of a git command run with --progress, yielding (line, progress) pairs. For progress
+       messages, <progress> is a tuple (phase, percent, bytes), where <bytes> is None unless git said how much it transferred
+       in total; otherwise it is None.'''
+    for line in lines:
+        m = re.match(r'(?:remote: *)?([A-Z][A-Za-z ]*): +([0-9]+)% \(', line)
+        yield (line, None if m is None else (m.group(1), int(m.group(2)), git_transfer_bytes(line)))
+
+def git_transfer(lines, report = None):
+    '''Go over the output <lines> of a push or fetch run with --progress, calling report(phase, percent) for every progress
+       message if given. Return a pair of the output without the progress messages, and how many bytes were transferred
+       (None if git did not say).'''
+    out = []
+    nbytes = None
+    for (line, progress) in git_progress(lines):
+        if progress is None:
+            out.append(line)
+            continue
+        (phase, percent, transferred) = progress
+        if transferred is not None:
+            nbytes = transferred
+        if report is not None:
+            report(phase, percent)
+    return ('\n'.join(out), nbytes)
+
+def git_missing_objects(git, shas):
+    '''Return the set of those <shas> that do not exist in the repository the GitCommand <git> works in.'''
+    out, code = git.cat_file('--batch-check', input = ''.join(sha+'\n' for sha in shas))
+    return set(line.split()[0] for line in out.split('\n') if line.endswith(' missing'))
+
 def read_config(defSection = 'DEFAULT'):
     '''Reads a config file that may have options outside of any section.'''
+    import configparser, itertools
     config = configparser.ConfigParser()
     with open(config_file) as file:
         stream = itertools.chain(("["+defSection+"]\n",), file)
         config.read_file(stream)
     return config
 
-def send_mail(subject, text, recipients, sender, replyTo = None):
-    assert isinstance(recipients, list)
-    if not len(recipients): return # nothing to do
+def make_mail(subject, text, recipients, sender, replyTo = None):
+    '''Return a triple of the sender, the recipients and the mail message.'''
+    import email.mime.text, email.utils
     # construct content
     msg = email.mime.text.MIMEText(text.encode('UTF-8'), 'plain', 'UTF-8')
     msg['Subject'] = subject
@@ -84,11 +385,376 @@ def send_mail(subject, text, recipients, sender, replyTo = None):
     msg['To'] = ', '.join(recipients)
     if replyTo is not None:
         msg['Reply-To'] = replyTo
-    # put into envelope and send
-    s = smtplib.SMTP('localhost')
-    s.sendmail(sender, recipients, msg.as_string())
+    return (sender, recipients, msg.as_string())
+
+def send_mails(mails):
+    '''Send all the <mails> (as returned by make_mail), using a single connection to the SMTP server.'''
+    mails = [mail for mail in mails if len(mail[1])]
+    if not mails: return # nothing to do
+    import smtplib
+    (host, _, port) = mail_smtp.partition(':')
+    s = smtplib.SMTP(host, int(port or 0))
+    for (sender, recipients, msg) in mails:
+        s.sendmail(sender, recipients, msg)
     s.quit()
 
+def send_mail(subject, text, recipients, sender, replyTo = None):
+    assert isinstance(recipients, list)
+    send_mails([make_mail(subject, text, recipients, sender, replyTo)])
+
+class MailSpool:
+    '''A directory of mails waiting to be sent by mail-sender.py. When processing the spool, the same error (ignoring SHAs)
+       for the same repository is mailed at most once per <window> seconds. If it happened again in the meantime, a digest
+       telling how often that was is sent when the window is over.'''
+    def __init__(self, dir):
+        self.dir = dir
+    
+    def add(self, repo, subject, text, recipients, sender):
+        import uuid
+        os.makedirs(self.dir, mode = 0o700, exist_ok = True)
+        mail = { 'time': time.time(), 'repo': repo, 'subject': subject, 'text': text, 'recipients': recipients, 'sender': sender }
+        name = "{:.6f}-{}".format(mail['time'], uuid.uuid4().hex)
+        # write to a temporary file first, so that the sender never sees half a mail
+        with open(os.path.join(self.dir, name+'.tmp'), 'w') as f:
+            json.dump(mail, f)
+        os.rename(os.path.join(self.dir, name+'.tmp'), os.path.join(self.dir, name+'.mail'))
+    
+    def pending(self):
+        return sorted(name for name in os.listdir(self.dir) if name.endswith('.mail')) if os.path.isdir(self.dir) else []
+    
+    def process(self, window):
+        '''Send the spooled mails and the digests that are due, all over one SMTP connection.'''
+        import fcntl, hashlib
+        os.makedirs(self.dir, mode = 0o700, exist_ok = True)
+        with open(os.path.join(self.dir, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state_file = os.path.join(self.dir, 'state.json')
+            try:
+                with open(state_file) as f:
+                    state = json.load(f) # maps error keys to what we know about the error
+            except (OSError, ValueError):
+                state = {}
+            now = time.time()
+            names = self.pending()
+            mails = []
+            for name in names:
+                with open(os.path.join(self.dir, name)) as f:
+                    mail = json.load(f)
+                text = re.sub('[0-9a-f]{40}', '<sha>', mail['text'])
+                key = hashlib.sha1(json.dumps([mail['repo'], mail['recipients'], mail['subject'], text]).encode('utf-8')).hexdigest()
+                error = state.get(key)
+                if error is None or now - error['sent'] >= window:
+                    mails.append(make_mail(mail['subject'], mail['text'], mail['recipients'], mail['sender']))
+                    state[key] = dict(mail, sent = now, repeated = 0)
+                else:
+                    error['repeated'] += 1
+                    error['last'] = mail['time']
+            # send digests for errors that happened again, and forget about those that did not
+            digests = {}
+            for (key, error) in list(state.items()):
+                if now - error['sent'] < window:
+                    continue
+                if error['repeated']:
+                    digests.setdefault((error['subject'], tuple(error['recipients']), error['sender']), []).append(
+                        "The following error happened {} more time(s), most recently at {}:\n\n{}".format(
+                            error['repeated'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(error['last'])), error['text']))
+                    error['sent'] = now
+                    error['repeated'] = 0
+                else:
+                    del state[key]
+            for ((subject, recipients, sender), texts) in sorted(digests.items()):
+                mails.append(make_mail(subject+" (digest)", '\n\n'.join(texts), list(recipients), sender))
+            send_mails(mails)
+            # only forget about the spooled mails once everything got sent
+            Metrics.write_atomically(state_file, json.dumps(state))
+            for name in names:
+                os.unlink(os.path.join(self.dir, name))
+
+def process_mail_spool():
+    '''Send the mails waiting in the spool, and the digests that are due.'''
+    MailSpool(os.path.join(state_dir, 'mail')).process(mail_dedup_window)
+
+class Metrics:
+    '''Collects how long the stages of syncing take, how many bytes they transfer and whether they succeed, per repository and
+       mirror. flush() adds the data to the totals in a Prometheus textfile (metrics-textfile) and appends them as one JSON
+       object per line to a log file (metrics-log), if these are configured.'''
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.textfile = None
+        self.logfile = None
+        self.reset()
+    
+    def enabled(self):
+        return self.textfile is not None or self.logfile is not None
+    
+    def reset(self):
+        self.events = [] # for the log file
+        self.histograms = {} # maps (name, labels) to a list of counts per bucket (plus one for +Inf), the sum and the count
+        self.counters = {} # maps (name, labels) to their increment
+        self.gauges = {} # maps (name, labels) to their value
+    
+    @staticmethod
+    def labels(labels):
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return ','.join('{}="{}"'.format(k, escape(v)) for (k, v) in sorted(labels.items()) if v is not None)
+    
+    def observe_histogram(self, name, value, **labels):
+        with self.lock:
+            h = self.histograms.setdefault((name, self.labels(labels)), [0]*(len(self.buckets)+1) + [0.0, 0])
+            h[next((i for (i, bound) in enumerate(self.buckets) if value <= bound), len(self.buckets))] += 1
+            h[-2] += value
+            h[-1] += 1
+    
+    def inc(self, name, value = 1, **labels):
+        with self.lock:
+            key = (name, self.labels(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, self.labels(labels))] = value
+    
+    def observe(self, stage, seconds, success, nbytes = None, **labels):
+        '''Record that <stage> took <seconds> and transferred <nbytes> (if known).'''
+        self.observe_histogram('git_mirror_stage_duration_seconds', seconds, stage = stage, **labels)
+        self.inc('git_mirror_stage_total', stage = stage, result = 'success' if success else 'failure', **labels)
+        if success:
+            self.set('git_mirror_stage_last_success_timestamp_seconds', time.time(), stage = stage, **labels)
+        if nbytes is not None:
+            self.inc('git_mirror_stage_bytes_total', nbytes, stage = stage, **labels)
+        event = dict(labels, time = time.time(), stage = stage, seconds = round(seconds, 6), result = 'success' if success else 'failure')
+        if nbytes is not None:
+            event['bytes'] = nbytes
+        with self.lock:
+            self.events.append(event)
+    
+    @contextlib.contextmanager
+    def time(self, stage, **labels):
+        '''Record how long the body of the with-statement takes. It fails if it raises an exception.'''
+        start = time.monotonic()
+        try:
+            yield
+        except:
+            self.observe(stage, time.monotonic() - start, False, **labels)
+            raise
+        self.observe(stage, time.monotonic() - start, True, **labels)
+    
+    def flush(self):
+        '''Write out what we collected so far, and forget it.'''
+        with self.lock:
+            (events, histograms, counters, gauges) = (self.events, self.histograms, self.counters, self.gauges)
+            self.reset()
+        if self.logfile is not None and events:
+            with open(self.logfile, 'a') as f:
+                f.write(''.join(json.dumps(event, sort_keys = True)+'\n' for event in events))
+        if self.textfile is not None and (histograms or counters or gauges):
+            import fcntl
+            # several processes add to the same totals, so we keep them in the state directory
+            os.makedirs(state_dir, mode = 0o700, exist_ok = True)
+            with open(os.path.join(state_dir, 'metrics.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                totals_file = os.path.join(state_dir, 'metrics.json')
+                try:
+                    with open(totals_file) as f:
+                        totals = json.load(f)
+                except (OSError, ValueError):
+                    totals = { 'histograms': {}, 'counters': {}, 'gauges': {} }
+                for ((name, labels), h) in histograms.items():
+                    total = totals['histograms'].setdefault(name+'|'+labels, [0]*len(h))
+                    totals['histograms'][name+'|'+labels] = [a+b for (a, b) in zip(total, h)]
+                for ((name, labels), value) in counters.items():
+                    totals['counters'][name+'|'+labels] = totals['counters'].get(name+'|'+labels, 0) + value
+                for ((name, labels), value) in gauges.items():
+                    totals['gauges'][name+'|'+labels] = value
+                self.write_atomically(totals_file, json.dumps(totals))
+                self.write_atomically(self.textfile, self.exposition(totals))
+    
+    def exposition(self, totals):
+        '''Format the <totals> in the Prometheus text format.'''
+        lines = []
+        def series(name, labels, extra = ''):
+            labels = ','.join(filter(None, (labels, extra)))
+            return "{}{{{}}}".format(name, labels) if labels else name
+        last_name = None
+        for (key, h) in sorted(totals['histograms'].items()):
+            (name, labels) = key.split('|', 1)
+            if name != last_name:
+                lines.append("# TYPE {} histogram".format(name))
+                last_name = name
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ('+Inf',), h):
+                cumulative += count
+                lines.append("{} {}".format(series(name+'_bucket', labels, 'le="{}"'.format(bound)), cumulative))
+            lines.append("{} {}".format(series(name+'_sum', labels), h[-2]))
+            lines.append("{} {}".format(series(name+'_count', labels), h[-1]))
+        for (kind, typ) in (('counters', 'counter'), ('gauges', 'gauge')):
+            for (key, value) in sorted(totals[kind].items()):
+                (name, labels) = key.split('|', 1)
+                if name != last_name:
+                    lines.append("# TYPE {} {}".format(name, typ))
+                    last_name = name
+                lines.append("{} {}".format(series(name, labels), value))
+        return ''.join(line+'\n' for line in lines)
+    
+    @staticmethod
+    def write_atomically(filename, data):
+        tmp_file = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+        os.replace(tmp_file, filename)
+
+metrics = Metrics()
+
+def git_transfer_bytes(out):
+    '''Return the number of bytes a push or fetch transferred, according to the progress output <out> of git, or None.'''
+    m = re.search(r'(?:Writing|Receiving) objects: 100% \([0-9]+/[0-9]+\), ([0-9.]+) (bytes|KiB|MiB|GiB)', out)
+    if m is None:
+        return None
+    return int(float(m.group(1)) * { 'bytes': 1, 'KiB': 1024, 'MiB': 1024**2, 'GiB': 1024**3 }[m.group(2)])
+
+def git_push_results(out):
+    '''Parse the output of git push --porcelain into a dict mapping the pushed refs to the SHA they are at on the remote side
+       now (the null SHA if they got deleted), or to None if they got rejected.'''
+    refs = {}
+    for line in out.split('\n'):
+        m = re.match(r'([ +*=!-])\t([^:\t]*):([^\t]+)\t', line)
+        if m is not None:
+            (flag, src, dst) = m.groups()
+            refs[dst] = None if flag == '!' else (src or git_nullsha)
+    return refs
+
+def read_json(filename):
+    '''Return the contents of the JSON file <filename>, or an empty dict if it does not exist (or is broken).'''
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+@contextlib.contextmanager
+def locked_json(filename):
+    '''Read the JSON file <filename> like read_json, let the caller change the data, and write it back atomically. A lock
+       file makes sure that nobody else does the same at the same time.'''
+    import fcntl
+    with open(filename+'.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = read_json(filename)
+        yield data
+        Metrics.write_atomically(filename, json.dumps(data))
+
+class RefCache:
+    '''What we last saw of the refs on the mirrors of a repository, learned from pushing there and from ls-remote. The data
+       is kept as JSON in the file <filename>, mapping mirrors to refs to a pair of the SHA (the null SHA if the ref does
+       not exist) and when we saw it. Entries older than <ttl> seconds are not trusted.'''
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+    
+    def lookup(self):
+        '''Return a dict mapping mirrors to dicts mapping refs to the SHA they are at, leaving out what is too old.'''
+        now = time.time()
+        return dict((mirror, dict((ref, sha) for (ref, (sha, seen)) in refs.items() if now - seen < self.ttl))
+                    for (mirror, refs) in read_json(self.filename).items())
+    
+    def record(self, seen, replace = False):
+        '''<seen> maps mirrors to dicts mapping refs to the SHA they are at now, or None if we do not know. If <replace>, these
+           are all the refs we care about, so forget everything else about the given mirrors.'''
+        now = time.time()
+        with locked_json(self.filename) as data:
+            for (mirror, refs) in seen.items():
+                entries = {} if replace else data.get(mirror, {})
+                for (ref, sha) in refs.items():
+                    if sha is None:
+                        entries.pop(ref, None)
+                    else:
+                        entries[ref] = (sha, now)
+                data[mirror] = dict((ref, entry) for (ref, entry) in entries.items() if now - entry[1] < self.ttl)
+
+# what ssh, git and we ourselves say when the connection to a host fails
+git_transport_errors = re.compile('|'.join([
+    r'Could not resolve host', r'Name or service not known', r'Temporary failure in name resolution',
+    r'Connection refused', r'Connection timed out', r'Operation timed out', r'No route to host',
+    r'Network is unreachable', r'Connection reset by peer', r'Connection closed by', r'kex_exchange_identification',
+    r'Failed to connect to', r'Timed out after \S+ seconds',
+]))
+
+def git_push_unreachable(out):
+    '''Return whether the output <out> of a failed push means that we could not talk to the host of the remote side,
+       e.g. because it is down. Other failures, like the remote side rejecting some of the refs or not accepting our
+       deploy key, are specific to one repository and do not say anything about the host.'''
+    return git_transport_errors.search(out) is not None
+
+def mirror_host(url):
+    '''Return the host that <url> points to, or <url> itself for local paths.'''
+    destination = ssh_destination(url)
+    if destination is not None:
+        return destination[0].split('@')[-1]
+    m = re.match(r'[a-z+]+://(?:[^@/]*@)?([^/:]+)', url)
+    return url if m is None else m.group(1)
+
+class CircuitBreakers:
+    '''Keeps track of which mirror hosts are down, for all repositories, in the JSON file <filename>. After <threshold>
+       failures in a row, the circuit for a host opens: for a while, nobody even tries to push there. That cool-down period
+       starts at <cooldown> seconds and doubles with every further failure, up to <max_cooldown>. After it, the next push
+       goes through to see whether the host is back.'''
+    def __init__(self, filename, threshold, cooldown, max_cooldown):
+        self.filename = filename
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+    
+    def down(self):
+        '''Return the set of hosts that are cooling down right now.'''
+        now = time.time()
+        return set(host for (host, state) in read_json(self.filename).items() if state['open_until'] > now)
+    
+    def record(self, results):
+        '''<results> maps hosts to whether talking to them worked. Return a dict mapping them to the state of their circuit:
+           "closed", "opened" if these failures just made it open, or "open" if it already was.'''
+        import random
+        now = time.time()
+        states = {}
+        with locked_json(self.filename) as data:
+            for (host, success) in results.items():
+                if success:
+                    data.pop(host, None)
+                    states[host] = "closed"
+                    continue
+                state = data.setdefault(host, { 'failures': 0, 'open_until': 0 })
+                state['failures'] += 1
+                if state['failures'] < self.threshold:
+                    states[host] = "closed"
+                    continue
+                states[host] = "open" if state['open_until'] else "opened"
+                # add some jitter, so that the hooks of all the repositories do not try again at the same moment
+                cooldown = min(self.max_cooldown, self.cooldown * 2**(state['failures'] - self.threshold))
+                state['open_until'] = now + cooldown * random.uniform(0.8, 1.2)
+        for (host, state) in states.items():
+            metrics.set('git_mirror_circuit_open', 0 if state == "closed" else 1, host = host)
+        return states
+
+def config_mirrors(conf):
+    '''Return the (mirror, URL) pairs configured in the repository section <conf>.'''
+    mirror_prefix = 'mirror-'
+    for name in filter(lambda s: s.startswith(mirror_prefix), conf.keys()):
+        yield (name[len(mirror_prefix):], conf[name])
+
+def compile_ref_filter(include, exclude):
+    '''Compile two lists of glob patterns into a single matcher, telling whether a ref matches any of the <include> patterns
+       (or <include> is empty) and none of the <exclude> patterns. As in fnmatch, * also matches slashes.'''
+    import fnmatch
+    def alternatives(patterns):
+        return '|'.join('(?:{})'.format(fnmatch.translate(pattern)) for pattern in patterns)
+    regex = ''
+    if exclude:
+        regex += '(?!{})'.format(alternatives(exclude))
+    if include:
+        regex += '(?:{})'.format(alternatives(include))
+    return re.compile(regex).match
+
 class Repo:
     def __init__(self, name, conf):
         '''Creates a repository from a section of the git-mirror configuration file'''
@@ -98,102 +764,981 @@ class Repo:
         self.hmac_secret = conf['hmac-secret'].encode('utf-8') if 'hmac-secret' in conf else None
         self.deploy_key = conf['deploy-key'] # the SSH ky used for authenticating against remote hosts
         self.mirrors = {} # maps mirrors to their URLs
-        mirror_prefix = 'mirror-'
-        for name in filter(lambda s: s.startswith(mirror_prefix), conf.keys()):
-            mirror = name[len(mirror_prefix):]
-            self.mirrors[mirror] = conf[name]
+        self.mirror_urls = {} # maps URLs to their mirrors
+        for mirror, url in config_mirrors(conf):
+            self.mirrors[mirror] = url
+            self.mirror_urls[url] = mirror
+        self.ref_globs = {} # maps mirrors to the (include, exclude) glob patterns for the refs synced with them
+        for mirror in self.mirrors:
+            include = conf.get('refs-include-'+mirror, conf.get('refs-include', ''))
+            exclude = conf.get('refs-exclude', '') + ' ' + conf.get('refs-exclude-'+mirror, '')
+            self.ref_globs[mirror] = (include.split(), exclude.split())
+        self._ref_filters = {}
+        self.push_workers = int(conf.get('push-workers', '4')) # how many mirrors to push to at the same time
+        self.push_timeout = float(conf['push-timeout']) if 'push-timeout' in conf else None # give up on a mirror after that many seconds
+        self.push_atomic = conf.get('push-atomic', 'yes') == 'yes' # whether to push several refs as one atomic transaction
+        self.reconcile_batch = int(conf.get('reconcile-batch', '500')) # how many refs to push at once when reconciling
+        self.seed_chunk = int(conf.get('seed-chunk', '1000')) # how many first-parent commits to push at once when seeding
+        self.git_backend_name = conf.get('git-backend', 'command') # "batch" to use long-lived git processes for ref operations
+        self.ssh_command = conf.get('ssh-command', 'ssh')
+        self.ssh_multiplex = conf.get('ssh-multiplex', 'no') == 'yes' # whether to share SSH connections between git commands
+        self.ssh_control_dir = conf.get('ssh-control-dir', os.path.join(state_dir, 'ssh'))
+        self.ssh_control_persist = conf.get('ssh-control-persist', '60') # how long to keep idle connections open
+        self._ssh_control_path = None # set up on first use
+        self.use_ref_cache = conf.get('ref-cache', 'no') == 'yes' # whether to skip pushing what the mirrors already have
+        self.ref_cache_ttl = float(conf.get('ref-cache-ttl', '3600'))
+        self.push_retries = int(conf.get('push-retries', '0')) # how often to try again when a mirror cannot be reached
+        self.push_retry_delay = float(conf.get('push-retry-delay', '1'))
+        self.breaker_threshold = int(conf.get('breaker-threshold', '0')) # after how many failures to stop trying a mirror host for a while
+        self.breaker_cooldown = float(conf.get('breaker-cooldown', '60'))
+        self.breaker_max_cooldown = float(conf.get('breaker-max-cooldown', '3600'))
+        import threading
+        self._git_backend = None
+        self._git_backend_lock = threading.Lock() # concurrent deliveries must not start a backend each
+    
+    def __getstate__(self):
+        # the git processes (and the lock) cannot be sent to another process
+        state = self.__dict__.copy()
+        state['_git_backend'] = None
+        del state['_git_backend_lock']
+        state['_ref_filters'] = {}
+        return state
+    
+    def __setstate__(self, state):
+        import threading
+        self.__dict__.update(state)
+        self._git_backend_lock = threading.Lock()
     
     def mail_owner(self, msg):
         global mail_sender
-        send_mail("git-mirror {}".format(self.name), msg, recipients = [self.owner], sender = mail_sender)
+        if not mail_spool:
+            send_mail("git-mirror {}".format(self.name), msg, recipients = [self.owner], sender = mail_sender)
+            return
+        # let mail-sender.py send the mail in the background, so that we do not have to wait for the SMTP server
+        MailSpool(os.path.join(state_dir, 'mail')).add(self.name, "git-mirror {}".format(self.name), msg, [self.owner], mail_sender)
+        subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'mail-sender.py'), '--once'],
+                         stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, start_new_session = True)
 
     def compute_hmac(self, data):
         assert self.hmac_secret is not None
+        import hmac, hashlib
         h = hmac.new(self.hmac_secret, digestmod = hashlib.sha1)
         h.update(data)
         return h.hexdigest()
     
+    def parse_github_payload(self, data, signature):
+        '''Check the <signature> GitHub sent along with <data>, and return the decoded JSON payload.'''
+        import hmac
+        if not hmac.compare_digest(signature, "sha1="+self.compute_hmac(data)):
+            raise Exception("You are not GitHub!")
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return {} # nothing read
+    
+    def github_push_update(self, data):
+        '''Extract the ref update from the payload of a GitHub push event. Return a tuple (ref, oldsha, newsha, mirror).'''
+        ref = data["ref"]
+        oldsha = data["before"]
+        newsha = data["after"]
+        # validate the ref name
+        if re.match('refs/[a-z/]+', ref) is None:
+            raise Exception("Invalid ref name {}".format(ref))
+        # collect URLs of this repository, to find the mirror name
+        urls = []
+        for key in ("git_url", "ssh_url", "clone_url"):
+            urls.append(data["repository"][key])
+        mirror = self.find_mirror_by_url(urls)
+        if mirror is None:
+            raise Exception("Could not find the mirror.")
+        return (ref, oldsha, newsha, mirror)
+    
+    def update_from_github_push(self, data):
+        '''Handle the payload of a GitHub push event: Update the local repository from the GitHub mirror, and then all the
+           other mirrors. Return a description of what happened.'''
+        (ref, oldsha, newsha, mirror) = self.github_push_update(data)
+        if not self.wants_ref(mirror, ref):
+            return "Not syncing {}:{} from mirror {} (filtered)".format(self.name, ref, mirror)
+        (updated, stdout) = self.update_ref_from_mirror(ref, oldsha, newsha, mirror, suppress_stderr = True)
+        if updated is None:
+            return "Did not update {}:{} from mirror {} to {}\n{}".format(self.name, ref, mirror, newsha, stdout)
+        return "Updated {}:{} from mirror {} from {} to {}\n{}".format(self.name, ref, mirror, updated[0], updated[1], stdout)
+    
+    def wants_ref(self, mirror, ref):
+        '''Tell whether <ref> is synced with <mirror>, according to refs-include and refs-exclude.'''
+        if mirror not in self._ref_filters:
+            self._ref_filters[mirror] = compile_ref_filter(*self.ref_globs[mirror])
+        return self._ref_filters[mirror](ref) is not None
+    
+    def filter_refs(self, mirror, refs):
+        '''Return the list of those <refs> that are not synced with <mirror>, and count them in the metrics.'''
+        filtered = sorted(set(ref for ref in refs if not self.wants_ref(mirror, ref)))
+        if filtered:
+            metrics.inc('git_mirror_filtered_refs_total', len(filtered), repo = self.name, mirror = mirror)
+        return filtered
+    
     def find_mirror_by_url(self, match_urls):
-        for mirror, url in self.mirrors.items():
-            if url in match_urls:
-                return mirror
+        for url in match_urls:
+            if url in self.mirror_urls:
+                return self.mirror_urls[url]
         return None
     
-    def setup_env(self):
-        '''Setup the environment to work with this repository'''
-        os.chdir(self.local)
-        ssh_set_ident = os.path.join(os.path.dirname(__file__), 'ssh-set-ident.sh')
-        os.putenv('GIT_SSH', ssh_set_ident)
-        ssh_ident = os.path.join(os.path.expanduser('~/.ssh'), self.deploy_key)
-        os.putenv('GIT_MIRROR_SSH_IDENT', ssh_ident)
+    def git_backend(self):
+        '''Return the GitBackend to use for ref operations in this repository, as configured with git-backend.'''
+        with self._git_backend_lock:
+            if self._git_backend is None:
+                self._git_backend = self.make_git_backend()
+            return self._git_backend
+    
+    def make_git_backend(self):
+        if self.git_backend_name == 'batch':
+            try:
+                # transactions need git 2.27 or newer
+                subprocess.run(["git", "update-ref", "--stdin"], cwd = self.local, input = b"start\nabort\n",
+                               stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True)
+                return BatchGitBackend(self.git())
+            except (OSError, subprocess.CalledProcessError):
+                sys.stderr.write("git-mirror: Cannot use the batch git backend, falling back to single commands\n")
+        return GitBackend(self.git())
+    
+    def close(self):
+        '''Stop the git processes kept running for this repository, if any.'''
+        with self._git_backend_lock:
+            if self._git_backend is not None:
+                self._git_backend.close()
+                self._git_backend = None
+    
+    def ssh_ident(self):
+        return os.path.join(os.path.expanduser('~/.ssh'), self.deploy_key)
+    
+    def ssh_control_path(self):
+        '''Return the ControlPath for the SSH master connections using our deploy key, or None if connection sharing is
+           disabled. The first call creates the directory for the sockets; this is needed for every git command, so the
+           result is kept.'''
+        if not self.ssh_multiplex:
+            return None
+        if self._ssh_control_path is None:
+            import hashlib
+            key_dir = os.path.join(self.ssh_control_dir, hashlib.sha1(self.ssh_ident().encode('utf-8')).hexdigest()[:12])
+            make_private_dir(self.ssh_control_dir)
+            make_private_dir(key_dir)
+            if len(key_dir) + 41 > 100:
+                raise Exception("SSH control directory {} is too long for a socket path.".format(self.ssh_control_dir))
+            self._ssh_control_path = os.path.join(key_dir, '%C') # ssh replaces this by a hash of the host, port and user
+        return self._ssh_control_path
+    
+    def start_ssh_masters(self, mirrors):
+        '''Make sure there is an SSH master connection to every host used by the given <mirrors>, if connection sharing
+           is enabled. Failing to start a master is not an error; git will then just connect directly.'''
+        control_path = self.ssh_control_path()
+        if control_path is None:
+            return
+        destinations = {}
+        for mirror in mirrors:
+            destination = ssh_destination(self.mirrors[mirror])
+            if destination is not None:
+                destinations[destination] = mirror
+        def start(mirror):
+            (destination, port) = ssh_destination(self.mirrors[mirror])
+            ssh = [self.ssh_command, '-i', self.ssh_ident(), '-o', 'ControlPath='+control_path] + (['-p', port] if port else [])
+            if subprocess.call(ssh + ['-O', 'check', destination], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) == 0:
+                return # already running
+            # start a master in the background, which exits after being idle for ssh-control-persist seconds.
+            # ssh removes stale sockets it finds in the way.
+            subprocess.call(ssh + ['-o', 'ControlMaster=yes', '-o', 'ControlPersist='+self.ssh_control_persist,
+                                   '-o', 'BatchMode=yes', '-f', '-N', destination],
+                            stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, timeout = self.push_timeout)
+        self.map_mirrors(start, destinations.values())
+    
+    def ref_cache(self):
+        '''Return the RefCache of this repository, or None if ref-cache is not enabled.'''
+        if not self.use_ref_cache:
+            return None
+        return RefCache(os.path.join(self.state_path(), 'refs.json'), self.ref_cache_ttl)
+    
+    def breakers(self):
+        '''Return the CircuitBreakers for the mirror hosts, or None if breaker-threshold is not set.'''
+        if self.breaker_threshold <= 0:
+            return None
+        make_private_dir(state_dir)
+        return CircuitBreakers(os.path.join(state_dir, 'breakers.json'), self.breaker_threshold, self.breaker_cooldown,
+                               self.breaker_max_cooldown)
+    
+    def deferred_refs(self):
+        '''Return a dict mapping mirrors to the refs they missed while they were down, mapped to the SHA they were at before.
+           Nothing gets deferred unless breaker-threshold is set.'''
+        if self.breakers() is None:
+            return {}
+        return read_json(os.path.join(self.state_path(), 'deferred.json'))
+    
+    def update_deferred_refs(self, add, remove):
+        '''<add> and <remove> map mirrors to refs to the SHA the mirror was at before, like deferred_refs returns. Remember
+           the refs in <add>, unless they are already deferred. Forget the refs in <remove>, unless they changed meanwhile.'''
+        with locked_json(os.path.join(self.state_path(), 'deferred.json')) as data:
+            for (mirror, refs) in add.items():
+                for (ref, sha) in refs.items():
+                    data.setdefault(mirror, {}).setdefault(ref, sha)
+            for (mirror, refs) in remove.items():
+                for (ref, sha) in refs.items():
+                    if data.get(mirror, {}).get(ref) == sha:
+                        del data[mirror][ref]
+            for mirror in list(data.keys()):
+                if not data[mirror]:
+                    del data[mirror]
+                metrics.set('git_mirror_deferred_refs', len(data.get(mirror, {})), repo = self.name, mirror = mirror)
+    
+    def git_env(self, **extra):
+        '''Return the environment to work with this repository, plus the variables in <extra>. This does not touch the
+           environment of our own process, so that several repositories can be worked with at the same time.'''
+        env = dict(os.environ)
+        env['GIT_SSH'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ssh-set-ident.sh')
+        env['GIT_MIRROR_SSH_IDENT'] = self.ssh_ident()
+        env['GIT_MIRROR_SSH_COMMAND'] = self.ssh_command
+        env['GIT_MIRROR_SSH_CONTROL_PATH'] = self.ssh_control_path() or ''
+        env['GIT_MIRROR_SSH_CONTROL_PERSIST'] = self.ssh_control_persist
+        env.update(extra)
+        return env
+    
+    def git(self):
+        '''Return a GitCommand running git in the local repository, with the environment from git_env.'''
+        return GitCommand(self.local, self.git_env())
+    
+    def git_stream(self):
+        '''Return a GitStream running git in the local repository, with the environment from git_env.'''
+        return GitStream(self.local, self.git_env())
+    
+    def map_mirrors(self, fn, mirrors):
+        '''Run fn(mirror) for all the given <mirrors>, with up to push-workers running at the same time. Return a dict mapping
+           each mirror to a pair of a success flag and either the result of fn, or the message of the exception it raised.'''
+        import concurrent.futures
+        def run(mirror):
+            try:
+                return (True, fn(mirror))
+            except Exception as e:
+                return (False, str(e))
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, self.push_workers)) as executor:
+            futures = dict((mirror, executor.submit(run, mirror)) for mirror in mirrors)
+            return dict((mirror, future.result()) for (mirror, future) in futures.items())
+    
+    def push_to_mirrors(self, pushes, report_progress = None):
+        '''<pushes> maps mirrors to the list of refspecs to push there. All the refspecs for one mirror are sent with a single
+           git push, and up to push-workers pushes are running concurrently. A failing mirror does not stop the others from
+           being updated. If <report_progress> is given, it is called as report_progress(mirror, phase, percent) whenever git
+           reports progress. Return a dict mapping each mirror to a pair of a success flag and the output of git (without
+           the progress messages).'''
+        self.start_ssh_masters(pushes.keys())
+        cache = self.ref_cache()
+        git_stream = self.git_stream()
+        def push(mirror):
+            url = self.mirrors[mirror]
+            refspecs = pushes[mirror]
+            # git only tells us how much it sent if we ask for progress
+            options = ['--progress'] if metrics.enabled() or report_progress is not None else []
+            if cache is not None:
+                options.append('--porcelain') # tells us what happened to every ref
+            report = None if report_progress is None else lambda phase, percent: report_progress(mirror, phase, percent)
+            def run(*args):
+                lines = git_stream.push(*options, *args, capture_stderr = True, check = False, timeout = self.push_timeout)
+                (out, nbytes) = git_transfer(lines, report)
+                return (lines.returncode == 0, out, nbytes)
+            def run_atomic():
+                if self.push_atomic and len(refspecs) > 1:
+                    # update all refs or none of them, if the remote side supports that
+                    (success, out, nbytes) = run('--atomic', url, *refspecs)
+                    if success or 'does not support --atomic' not in out:
+                        return (success, out, nbytes)
+                return run(url, *refspecs)
+            import random
+            for attempt in range(self.push_retries + 1):
+                try:
+                    (success, out, nbytes) = run_atomic()
+                    if success or not git_push_unreachable(out) or attempt == self.push_retries:
+                        return (success, out, nbytes)
+                except Exception:
+                    if attempt == self.push_retries:
+                        raise
+                # wait a bit longer every time, and add some jitter
+                time.sleep(self.push_retry_delay * 2**attempt * random.uniform(0.5, 1.5))
+        def timed_push(mirror):
+            start = time.monotonic()
+            try:
+                (success, out, nbytes) = push(mirror)
+            except Exception:
+                metrics.observe('push', time.monotonic() - start, False, repo = self.name, mirror = mirror)
+                raise
+            metrics.observe('push', time.monotonic() - start, success, nbytes, repo = self.name, mirror = mirror)
+            return (success, out)
+        results = self.map_mirrors(timed_push, pushes.keys())
+        if cache is not None:
+            cache.record(dict((mirror, git_push_results(result[1])) for (mirror, (success, result)) in results.items() if success))
+        return dict((mirror, result if success else (False, result)) for (mirror, (success, result)) in results.items())
     
     def update_mirrors(self, ref, oldsha, newsha):
         '''Update the <ref> from <oldsha> to <newsha> on all mirrors. The update must already have happened locally.'''
-        assert len(oldsha) == 40 and len(newsha) == 40, "These are not valid SHAs."
-        source_mirror = os.getenv("GIT_MIRROR_SOURCE") # in case of a self-call via the hooks, we can skip one of the mirrors
-        self.setup_env()
-        # check for a forced update
-        is_forced = newsha != git_nullsha and oldsha != git_nullsha and git_is_forced_update(oldsha, newsha)
-        # tell all the mirrors
+        self.update_mirrors_batch([(ref, oldsha, newsha)])
+    
+    def update_mirrors_batch(self, updates, source_mirror = None):
+        '''<updates> is a list of (ref, oldsha, newsha) triples, as received by a post-receive hook. Apply all of them to all
+           mirrors except for <source_mirror>, using a single push per mirror. The updates must already have happened locally.
+           Mirrors on a host whose circuit is open are skipped; the refs they miss are pushed together with the next update
+           that gets through to them.'''
+        for (ref, oldsha, newsha) in updates:
+            assert len(oldsha) == 40 and len(newsha) == 40, "These are not valid SHAs."
+        deferred = self.deferred_refs()
+        if not updates and not deferred: return # nothing to do
+        if source_mirror is None:
+            source_mirror = os.getenv("GIT_MIRROR_SOURCE") # in case of a self-call via the hooks, we can skip one of the mirrors
+        mirror_updates = {} # the updates each mirror gets, leaving out the filtered refs
         for mirror in self.mirrors:
             if mirror == source_mirror:
                 continue
-            sys.stdout.write("Updating mirror {}\n".format(mirror)); sys.stdout.flush()
-            # update this mirror
-            if is_forced:
-                # forcibly update ref remotely (someone already did a force push and hence accepted data loss)
-                git.push('--force', self.mirrors[mirror], newsha+":"+ref)
-            else:
-                # nicely update ref remotely (this avoids data loss due to race conditions)
-                git.push(self.mirrors[mirror], newsha+":"+ref)
+            filtered = self.filter_refs(mirror, (ref for (ref, oldsha, newsha) in updates))
+            if filtered:
+                sys.stdout.write("Not pushing {} to mirror {} (filtered)\n".format(', '.join(filtered), mirror))
+            mirror_updates[mirror] = [update for update in updates if update[0] not in filtered]
+        mirrors = [mirror for mirror in mirror_updates if mirror_updates[mirror] or mirror in deferred]
+        breakers = self.breakers()
+        down_hosts = set() if breakers is None else breakers.down()
+        down = [mirror for mirror in mirrors if mirror_host(self.mirrors[mirror]) in down_hosts]
+        # figure out where each mirror is: where the updates started, unless it missed some earlier updates
+        local = dict((ref, newsha) for (ref, oldsha, newsha) in updates)
+        behind = {}
+        for mirror in mirrors:
+            if mirror not in down:
+                behind[mirror] = dict((ref, oldsha) for (ref, oldsha) in deferred.get(mirror, {}).items() if self.wants_ref(mirror, ref))
+                for (ref, oldsha, newsha) in mirror_updates[mirror]:
+                    behind[mirror].setdefault(ref, oldsha)
+        missed = set(ref for refs in behind.values() for ref in refs if ref not in local)
+        if missed:
+            local.update(self.git_backend().resolve_refs(sorted(missed)))
+        # check for forced updates
+        checks = sorted(set((oldsha, local[ref]) for refs in behind.values() for (ref, oldsha) in refs.items()
+                            if oldsha != git_nullsha and local[ref] != git_nullsha and oldsha != local[ref]))
+        forced = dict(zip(checks, self.git_backend().forced_updates(checks)))
+        pushes = {}
+        for (mirror, refs) in behind.items():
+            refspecs = []
+            for (ref, oldsha) in refs.items():
+                if oldsha == local[ref]:
+                    continue # it got back to where the mirror is
+                is_forced = forced.get((oldsha, local[ref]), False)
+                # forcibly update ref remotely if someone already did a force push and hence accepted data loss, otherwise
+                # nicely update ref remotely (this avoids data loss due to race conditions). Pushing the null SHA deletes the ref.
+                refspecs.append((ref, ("+" if is_forced else "")+local[ref]+":"+ref))
+            pushes[mirror] = refspecs
+        # tell all the mirrors at the same time
+        cache = self.ref_cache()
+        if cache is not None:
+            # do not push what the mirrors already have, e.g. because the update is echoing back to us
+            known = cache.lookup()
+            for (mirror, refspecs) in pushes.items():
+                todo = [(ref, refspec) for (ref, refspec) in refspecs if known.get(mirror, {}).get(ref) != local[ref]]
+                metrics.inc('git_mirror_ref_cache_lookups_total', len(refspecs), repo = self.name, mirror = mirror)
+                metrics.inc('git_mirror_ref_cache_hits_total', len(refspecs) - len(todo), repo = self.name, mirror = mirror)
+                if refspecs and not todo:
+                    metrics.inc('git_mirror_ref_cache_skipped_pushes_total', repo = self.name, mirror = mirror)
+                pushes[mirror] = todo
+        results = self.push_to_mirrors(dict((mirror, [refspec for (ref, refspec) in refspecs])
+                                            for (mirror, refspecs) in pushes.items() if refspecs))
+        states = {}
+        if breakers is not None:
+            states = breakers.record(dict((mirror_host(self.mirrors[mirror]), success or not git_push_unreachable(out))
+                                          for (mirror, (success, out)) in results.items()))
+        failed = []
+        errors = {}
+        add = {}
+        remove = {}
+        for mirror in mirrors:
+            state = states.get(mirror_host(self.mirrors[mirror]))
+            if mirror in down:
+                sys.stdout.write("Mirror {} is down, it will get the update later\n".format(mirror))
+                add[mirror] = dict((ref, oldsha) for (ref, oldsha, newsha) in mirror_updates[mirror])
+                continue
+            if mirror not in results:
+                sys.stdout.write("Mirror {} is already up-to-date\n".format(mirror))
+                remove[mirror] = deferred.get(mirror, {})
+                continue
+            success, out = results[mirror]
+            if success:
+                sys.stdout.write("Updated mirror {}\n".format(mirror))
+                remove[mirror] = deferred.get(mirror, {})
+                continue
+            if breakers is not None and git_push_unreachable(out):
+                add[mirror] = dict((ref, oldsha) for (ref, oldsha, newsha) in mirror_updates[mirror])
+                if state == "opened":
+                    out += "\n\nGiving up on {} for a while; the updates will be pushed once it is back.".format(mirror_host(self.mirrors[mirror]))
+                elif state == "open":
+                    # we already told the owner when the circuit opened
+                    sys.stdout.write("Mirror {} is still down, it will get the update later\n".format(mirror))
+                    continue
+            elif deferred.get(mirror):
+                # the mirror refused the push (e.g. rejected a ref); do not let that keep failing all the later pushes, reconcile.py can sort it out
+                remove[mirror] = deferred[mirror]
+            sys.stdout.write("Failed to update mirror {}:\n{}\n".format(mirror, out))
+            failed.append(mirror)
+            errors[mirror] = out
+        if breakers is not None:
+            self.update_deferred_refs(add, remove)
+        sys.stdout.flush()
+        if failed:
+            raise Exception("Updating {} failed on mirror(s) {}:\n\n{}".format(', '.join(sorted(local)),
+                ', '.join(failed), '\n\n'.join("{}:\n{}".format(mirror, errors[mirror]) for mirror in failed)))
+    
+    def catch_up(self):
+        '''Push the refs that mirrors missed while they were down to those of them that are not known to be down anymore.'''
+        self.update_mirrors_batch([])
+    
+    def reconcile_plan(self, mirrors):
+        '''Compare the branches and tags of the local repository with those on the given <mirrors>, using a single ls-remote
+           per mirror. Return a dict mapping each mirror to a triple of a success flag, either the list of differences or an
+           error message, and how many refs the ref cache was wrong about (None if it is not enabled). A difference is a
+           tuple (kind, ref, remotesha, localsha), where kind is one of "new", "fast-forward", "forced", "ahead" if the
+           mirror has commits on top of the local ref, "remote-only" if the ref only exists on the mirror, "unknown" if the
+           mirror has commits we do not have, or "filtered" if the ref is not synced with the mirror. We cannot tell
+           whether the commits of "ahead" and "remote-only" refs are new on the mirror (and only got fetched, but never
+           made it to the local ref) or old, so reconcile only touches them when asked to.'''
+        git_stream = self.git_stream()
+        lines = git_stream.show_ref('--heads', '--tags', check = False)
+        local_refs = git_parse_refs(lines)
+        if lines.returncode not in (0, 1):
+            raise Exception("Something went wrong getting the local refs.")
+        self.start_ssh_masters(mirrors)
+        def ls_remote(mirror):
+            with metrics.time('ls_remote', repo = self.name, mirror = mirror):
+                return git_parse_refs(git_stream.ls_remote('--heads', '--tags', self.mirrors[mirror], timeout = self.push_timeout))
+        remote_refs = self.map_mirrors(ls_remote, mirrors)
+        # this is also our chance to check what the ref cache believes, and to refresh it
+        cache = self.ref_cache()
+        cache_errors = dict((mirror, None) for mirror in mirrors)
+        if cache is not None:
+            known = cache.lookup()
+            for (mirror, (success, refs)) in remote_refs.items():
+                if success:
+                    cache_errors[mirror] = sum(1 for (ref, sha) in known.get(mirror, {}).items()
+                                               if ref.startswith(('refs/heads/', 'refs/tags/')) and refs.get(ref, git_nullsha) != sha)
+                    metrics.inc('git_mirror_ref_cache_errors_total', cache_errors[mirror], repo = self.name, mirror = mirror)
+            cache.record(dict((mirror, refs) for (mirror, (success, refs)) in remote_refs.items() if success), replace = True)
+        # find out which of the remote commits we know about
+        remote_shas = set()
+        for (success, refs) in remote_refs.values():
+            if success:
+                remote_shas.update(refs.values())
+        missing = git_missing_objects(self.git(), remote_shas) if remote_shas else set()
+        plans = {}
+        for mirror in mirrors:
+            (success, refs) = remote_refs[mirror]
+            if not success:
+                plans[mirror] = (False, refs, None)
+                continue
+            plan = []
+            for ref in sorted(set(local_refs) | set(refs)):
+                localsha = local_refs.get(ref, git_nullsha)
+                remotesha = refs.get(ref, git_nullsha)
+                if localsha == remotesha:
+                    continue
+                if not self.wants_ref(mirror, ref):
+                    kind = "filtered"
+                elif remotesha == git_nullsha:
+                    kind = "new"
+                elif remotesha in missing:
+                    kind = "unknown" # someone pushed there, and we did not get it
+                elif localsha == git_nullsha:
+                    kind = "remote-only"
+                else:
+                    kind = None # decided below
+                plan.append([kind, ref, remotesha, localsha])
+            # check all the updates of existing refs for being forced at once
+            checks = [(remotesha, localsha) for (kind, ref, remotesha, localsha) in plan if kind is None]
+            forced = dict(zip(checks, self.git_backend().forced_updates(checks)))
+            # for those that would be forced, check whether the mirror is just ahead of us
+            checks = [(localsha, remotesha) for (kind, ref, remotesha, localsha) in plan if kind is None and forced[(remotesha, localsha)]]
+            behind = dict(zip(checks, self.git_backend().forced_updates(checks)))
+            for diff in plan:
+                if diff[0] is None:
+                    if not forced[(diff[2], diff[3])]:
+                        diff[0] = "fast-forward"
+                    elif not behind[(diff[3], diff[2])]:
+                        diff[0] = "ahead"
+                    else:
+                        diff[0] = "forced"
+            plans[mirror] = (True, [tuple(diff) for diff in plan], cache_errors[mirror])
+        return plans
+    
+    def reconcile(self, mirrors = None, dry_run = False, report_progress = None, overwrite = False):
+        '''Bring the branches and tags of the given <mirrors> (default: all) in sync with the local repository, pushing only
+           the refs that differ, in batches of reconcile-batch refs. Refs the mirror has moved ahead of the local
+           repository, or that only exist on the mirror, are only rewound or deleted if <overwrite> is set. If <dry_run>,
+           just report what would be done. <report_progress> is passed on to push_to_mirrors. Return the report as a list
+           of lines.'''
+        if mirrors is None:
+            mirrors = list(self.mirrors.keys())
+        deferred = self.deferred_refs()
+        plans = self.reconcile_plan(mirrors)
+        report = []
+        failed = []
+        pushes = {}
+        for mirror in mirrors:
+            (success, plan, cache_errors) = plans[mirror]
+            if not success:
+                report.append("{}: {}: Failed to get the remote state:\n{}".format(self.name, mirror, plan))
+                failed.append(mirror)
+                continue
+            if cache_errors:
+                report.append("{}: {}: The ref cache was wrong about {} ref(s)".format(self.name, mirror, cache_errors))
+            filtered = sum(1 for diff in plan if diff[0] == "filtered")
+            if filtered:
+                report.append("{}: {}: Left {} filtered ref(s) alone".format(self.name, mirror, filtered))
+            if len(plan) == filtered:
+                report.append("{}: {}: In sync".format(self.name, mirror))
+            refspecs = []
+            for (kind, ref, remotesha, localsha) in plan:
+                if kind == "filtered":
+                    continue
+                report.append("{}: {}: {} {} {}..{}".format(self.name, mirror, kind, ref, remotesha[:12], localsha[:12]))
+                if kind == "unknown" or (kind in ("ahead", "remote-only") and not overwrite):
+                    continue
+                if kind == "remote-only":
+                    refspecs.append(":"+ref)
+                else:
+                    refspecs.append(("+" if kind in ("forced", "ahead") else "")+localsha+":"+ref)
+            if refspecs:
+                pushes[mirror] = refspecs
+        if not dry_run:
+            # push the batches, for all mirrors at the same time
+            pushed = list(pushes.keys())
+            batch = 0
+            while pushes:
+                results = self.push_to_mirrors(dict((mirror, refspecs[batch:batch+self.reconcile_batch]) for (mirror, refspecs) in pushes.items()),
+                                               report_progress)
+                batch += self.reconcile_batch
+                for (mirror, (success, out)) in results.items():
+                    if not success:
+                        report.append("{}: {}: Failed to push:\n{}".format(self.name, mirror, out))
+                        failed.append(mirror)
+                pushes = dict((mirror, refspecs) for (mirror, refspecs) in pushes.items() if results[mirror][0] and len(refspecs) > batch)
+            report.extend("{}: {}: Done".format(self.name, mirror) for mirror in pushed if mirror not in failed)
+            if deferred:
+                # whatever these mirrors missed while they were down, they have it now
+                self.update_deferred_refs({}, dict((mirror, refs) for (mirror, refs) in deferred.items() if mirror in mirrors and mirror not in failed))
+        if failed:
+            raise Exception("Reconciling failed on mirror(s) {}:\n\n{}".format(', '.join(failed), '\n'.join(report)))
+        return report
+    
+    def seed(self, mirror, chunk = None, report = None):
+        '''Push everything to the new <mirror>, in pieces of bounded size: First walk the first-parent history of the
+           default branch, pushing every <chunk>-th commit (default: seed-chunk) to a temporary ref, then push all the
+           branches and tags in batches of reconcile-batch refs. What got done is checkpointed in the state directory, so
+           that calling this again after an interruption picks up where it stopped. Finally, remove the temporary ref and
+           forget about the refs the mirror missed while it was down. <report> is called with a line describing every step.'''
+        if chunk is None:
+            chunk = self.seed_chunk
+        if report is None:
+            report = lambda line: None
+        checkpoint_file = os.path.join(self.state_path('seed'), mirror+'.json')
+        import fcntl
+        lock_file = checkpoint_file+'.lock'
+        while True:
+            lock = open(lock_file, 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                raise Exception("Mirror {} is already being seeded.".format(mirror))
+            # a seed that just finished removes the lock file; then we got a lock nobody else sees, try again
+            try:
+                if os.path.samestat(os.stat(lock_file), os.fstat(lock.fileno())):
+                    break
+            except FileNotFoundError:
+                pass
+            lock.close()
+        with lock:
+            self.seed_locked(mirror, chunk, report, checkpoint_file)
+            os.unlink(lock_file) # while still holding the lock, see above
+    
+    def seed_locked(self, mirror, chunk, report, checkpoint_file):
+        '''Do the work of seed, while holding the lock for <checkpoint_file>.'''
+        url = self.mirrors[mirror]
+        git = self.git()
+        git_stream = self.git_stream()
+        checkpoint = read_json(checkpoint_file)
+        if checkpoint.get('url') != url:
+            checkpoint = { 'url': url, 'commit': None, 'ref': None, 'history_done': False }
+        def save():
+            Metrics.write_atomically(checkpoint_file, json.dumps(checkpoint))
+        def push(refspecs):
+            (success, out) = self.push_to_mirrors({ mirror: refspecs })[mirror]
+            if not success:
+                raise Exception("Seeding {} failed:\n{}".format(mirror, out))
+        if not checkpoint['history_done']:
+            # the default branch should have most of the history
+            (head, code) = git.symbolic_ref('-q', 'HEAD', check = False)
+            candidates = ([head] if code == 0 else []) + ['refs/heads/main', 'refs/heads/master']
+            local = self.git_backend().resolve_refs(candidates)
+            head = next((ref for ref in candidates if local[ref] != git_nullsha and self.wants_ref(mirror, ref)), None)
+            if head is not None:
+                def walk(after):
+                    '''Push the history in chunks, skipping everything up to the commit <after>. Return whether that was found.'''
+                    found = after is None
+                    count = 0
+                    for sha in git_stream.rev_list('--first-parent', '--reverse', head):
+                        if not found:
+                            found = sha == after
+                            continue
+                        count += 1
+                        if count % chunk == 0:
+                            push(['+{}:{}'.format(sha, seed_ref)])
+                            checkpoint['commit'] = sha
+                            save()
+                            report("Pushed the history of {} up to {}".format(head, sha[:12]))
+                    return found
+                if not walk(checkpoint['commit']):
+                    # the history got rewritten since; what the mirror already has does not get sent again anyway
+                    walk(None)
+            checkpoint['history_done'] = True
+            save()
+        # now the refs, in the order show-ref lists them
+        lines = git_stream.show_ref('--heads', '--tags', check = False)
+        batch = []
+        def push_batch():
+            push(['{}:{}'.format(sha, ref) for (sha, ref) in batch])
+            checkpoint['ref'] = batch[-1][1]
+            save()
+            report("Pushed {} refs (up to {})".format(len(batch), batch[-1][1]))
+            batch.clear()
+        filtered = 0
+        for (sha, ref) in git_refs(lines):
+            if checkpoint['ref'] is not None and ref <= checkpoint['ref']:
+                continue # done before
+            if not self.wants_ref(mirror, ref):
+                filtered += 1
+                continue
+            batch.append((sha, ref))
+            if len(batch) == self.reconcile_batch:
+                push_batch()
+        if lines.returncode not in (0, 1):
+            raise Exception("Something went wrong getting the local refs.")
+        if batch:
+            push_batch()
+        if filtered:
+            report("Left out {} filtered ref(s)".format(filtered))
+        # clean up, and consider the mirror to be in sync
+        if checkpoint['commit'] is not None:
+            push([':'+seed_ref])
+            checkpoint['commit'] = None
+            save()
+        deferred = self.deferred_refs().get(mirror)
+        if deferred:
+            self.update_deferred_refs({}, { mirror: deferred })
+        os.unlink(checkpoint_file)
+        report("Done")
+    
+    def state_path(self, *names):
+        '''Return the path of the directory <names> inside the state directory of this repository, creating it if needed.'''
+        path = os.path.join(state_dir, 'repos', self.name)
+        make_private_dir(path)
+        for name in names:
+            path = os.path.join(path, name)
+            make_private_dir(path)
+        return path
+    
+    @contextlib.contextmanager
+    def lock(self):
+        '''Hold the lock that serializes updating the local repository from the mirrors.'''
+        import fcntl
+        with open(os.path.join(self.state_path(), 'lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
     
     def update_ref_from_mirror(self, ref, oldsha, newsha, mirror, suppress_stderr = False):
-        '''Update the local version of this <ref> to what's currently on the given <mirror>. <oldsha> and <newsha> are checked. Then update all the other mirrors.'''
-        self.setup_env()
+        '''Update the local version of this <ref> to what's currently on the given <mirror>. <oldsha> and <newsha> are checked. Then update all the other mirrors.
+           Concurrent calls for the same repository do not run at the same time. Instead, the updates that come in while one
+           is running are recorded, and all handled together by whichever call gets the lock next. Return a pair of the old
+           and new SHA of the local ref (None if it did not change), and the output.'''
+        import uuid
+        # record what we want to have done
+        id = "{:.6f}-{}".format(time.time(), uuid.uuid4().hex) # sorting these gives the order in which updates came in
+        pending_dir = self.state_path('pending')
+        entry_file = os.path.join(pending_dir, id+'.json')
+        with open(entry_file+'.tmp', 'w') as f:
+            json.dump({ 'ref': ref, 'oldsha': oldsha, 'newsha': newsha, 'mirror': mirror }, f)
+        os.rename(entry_file+'.tmp', entry_file)
+        with self.lock():
+            if os.path.exists(entry_file):
+                result = self.update_pending_from_mirrors(id, suppress_stderr)
+            else:
+                # somebody else already handled our update while we were waiting for the lock
+                result_file = os.path.join(pending_dir, id+'.result')
+                if not os.path.exists(result_file):
+                    raise Exception("The update of {} from {} to {} got lost.".format(ref, oldsha, newsha))
+                with open(result_file) as f:
+                    result = json.load(f)
+                os.unlink(result_file)
+        if result['error'] is not None:
+            raise Exception(result['error'])
+        return (result['updated'], result['output'])
+    
+    def update_pending_from_mirrors(self, own_id, suppress_stderr = False):
+        '''Handle all the updates recorded by update_ref_from_mirror, with one batch per mirror. Leave a result file for
+           everybody else waiting for their update; return the result for <own_id>. The caller has to hold the lock.'''
+        pending_dir = self.state_path('pending')
+        names = sorted(name[:-len('.json')] for name in os.listdir(pending_dir) if name.endswith('.json'))
+        batches = {}
+        for id in names:
+            with open(os.path.join(pending_dir, id+'.json')) as f:
+                entry = json.load(f)
+            batches.setdefault(entry['mirror'], []).append((id, entry))
+        results = {}
+        for (mirror, entries) in batches.items():
+            try:
+                (output, failed, updated) = self.update_refs_from_mirror([(entry['ref'], entry['oldsha'], entry['newsha']) for (id, entry) in entries],
+                                                                         mirror, suppress_stderr)
+                for (id, entry) in entries:
+                    results[id] = { 'output': output, 'error': failed.get((entry['ref'], entry['oldsha'], entry['newsha'])),
+                                    'updated': updated.get(entry['ref']) }
+            except Exception as e:
+                for (id, entry) in entries:
+                    results[id] = { 'output': None, 'error': str(e), 'updated': None }
+        # hand out the results, and only then forget about the updates
+        for (id, result) in results.items():
+            if id != own_id:
+                Metrics.write_atomically(os.path.join(pending_dir, id+'.result'), json.dumps(result))
+            os.unlink(os.path.join(pending_dir, id+'.json'))
+        # clean up results nobody picked up, e.g. because the webhook got killed while waiting
+        for name in os.listdir(pending_dir):
+            if name.endswith('.result') and os.path.getmtime(os.path.join(pending_dir, name)) < time.time() - 24*60*60:
+                os.unlink(os.path.join(pending_dir, name))
+        return results[own_id]
+    
+    def update_refs_from_mirror(self, updates, mirror, suppress_stderr = False):
+        '''Update the local version of the refs in <updates>, a list of (ref, oldsha, newsha) tuples, to what's currently on
+           the given <mirror>, using a single fetch, ref transaction and run of the post-receive hook. Then update all the
+           other mirrors. There can be several updates of the same ref. The SHAs are checked like update_ref_from_mirror does:
+           A ref is only updated to where the remote is if one of the updates says so; updates that ended elsewhere must
+           be in the history of the ref, locally or remotely. Updates that are in the history of the remote ref only are
+           remembered in the state directory until the update to where the remote is comes in, because they did not
+           happen locally yet. Refs that are not synced with <mirror> are left alone. Return a triple of the output of the
+           hook, a dict mapping the (ref, oldsha, newsha) updates that failed to an error message, and a dict mapping the
+           refs that changed locally to a pair of their old and new SHA. The caller has to hold the lock.'''
+        filtered = self.filter_refs(mirror, (ref for (ref, oldsha, newsha) in updates))
+        note = "Not syncing {} from mirror {} (filtered)\n".format(', '.join(filtered), mirror) if filtered else ""
+        updates = [update for update in updates if update[0] not in filtered]
+        if not updates:
+            return (note, {}, {})
+        git_stream = self.git_stream()
+        self.start_ssh_masters([mirror]) # we are going to connect there twice
         url = self.mirrors[mirror]
+        updates_by_ref = {}
+        for (ref, oldsha, newsha) in updates:
+            updates_by_ref.setdefault(ref, []).append((oldsha, newsha))
+        # earlier updates we accepted, but could not apply yet: locally, we can still be where they started
+        waiting_file = os.path.join(self.state_path(), 'waiting.json')
+        waiting = read_json(waiting_file)
+        waiting_since = {}
+        for (ref, shas) in updates_by_ref.items():
+            for (oldsha, newsha, since) in waiting.get(mirror, {}).get(ref, []):
+                if (oldsha, newsha) not in shas and since > time.time() - 24*60*60:
+                    shas.append((oldsha, newsha))
+                    waiting_since[(ref, oldsha, newsha)] = since
         # first check whether the remote really is at newsha
-        remote_state, code = git.ls_remote(url, ref)
-        if remote_state:
-            remote_sha = remote_state.split()[0]
-        else:
-            remote_sha = git_nullsha
-        assert newsha == remote_sha, "Someone lied about the new SHA, which should be {}.".format(newsha)
-        # locally, we have to be at oldsha or newsha (the latter can happen if we already got this update, e.g. if it originated from us)
-        local_state, code = git.show_ref(ref, check=False)
-        if code == 0:
-            local_sha = local_state.split()[0]
-        else:
-            if len(local_state):
-                raise Exception("Something went wrong getting the local state of {}.".format(ref))
-            local_sha = git_nullsha
-        # some sanity checking, but deal gracefully with new branches appearing
-        assert local_sha in (git_nullsha, oldsha, newsha), "Someone lied about the old SHA: Local ({}) is neither old ({}) nor new ({})".format(local_sha, oldsha, newsha)
-        # if we are already at newsha locally, we also ran the local hooks, so we do not have to do anything
-        if local_sha == newsha:
-            return "Local repository is already up-to-date."
-        # update local state from local_sha to newsha.
-        if newsha != git_nullsha:
-            # We *could* now fetch the remote ref and immediately update the local one. However, then we would have to
-            # decide whether we want to allow a force-update or not. Also, the ref could already have changed remotely,
+        with metrics.time('ls_remote', repo = self.name, mirror = mirror):
+            remote_refs = git_parse_refs(git_stream.ls_remote(url, *updates_by_ref))
+        cache = self.ref_cache()
+        if cache is not None:
+            cache.record({ mirror: dict((ref, remote_refs.get(ref, git_nullsha)) for ref in updates_by_ref) })
+        local_refs = self.git_backend().resolve_refs(list(updates_by_ref))
+        git = self.git()
+        failed = {}
+        changes = [] # list of (ref, oldsha to tell the hook, local_sha, remote_sha)
+        superseded = [] # list of (ref, oldsha, newsha) that have to be in the history of where the ref is, locally or remotely
+        for (ref, shas) in updates_by_ref.items():
+            remote_sha = remote_refs.get(ref, git_nullsha)
+            local_sha = local_refs[ref]
+            oldshas = set(oldsha for (oldsha, newsha) in shas)
+            newshas = set(newsha for (oldsha, newsha) in shas)
+            for (oldsha, newsha) in shas:
+                if newsha in (local_sha, remote_sha):
+                    continue # checked below
+                if newsha == git_nullsha:
+                    failed[(ref, oldsha, newsha)] = "Someone lied about the new SHA of {}, which should be {}.".format(ref, remote_sha)
+                else:
+                    # the ref moved on since; we will check that once we have the history
+                    superseded.append((ref, oldsha, newsha))
+            if local_sha == remote_sha or remote_sha not in newshas:
+                # if we are already at newsha locally, we also ran the local hooks, so we do not have to do anything.
+                # if nobody told us about where the remote is yet, the update that does will take care of it.
+                continue
+            current = [(oldsha, newsha) for (oldsha, newsha) in shas if newsha == remote_sha]
+            if local_sha not in oldshas | newshas | {git_nullsha}:
+                # locally, we have to be where one of the updates started or ended
+                # some sanity checking, but deal gracefully with new branches appearing
+                for (oldsha, newsha) in current:
+                    failed[(ref, oldsha, newsha)] = "Someone lied about the old SHA of {}: Local ({}) is neither old ({}) nor new ({})".format(
+                        ref, local_sha, ', '.join(sorted(oldshas)), ', '.join(sorted(newshas)))
+            else:
+                changes.append((ref, local_sha if local_sha in oldshas else current[0][0], local_sha, remote_sha))
+        # update local state from local_sha to remote_sha, and get what we need to check the superseded updates.
+        missing = git_missing_objects(git, set(remote_refs.values()))
+        fetch_refs = sorted(set([ref for (ref, oldsha, local_sha, remote_sha) in changes if remote_sha != git_nullsha] +
+                                [ref for (ref, oldsha, newsha) in superseded if remote_refs.get(ref, git_nullsha) in missing]))
+        if fetch_refs:
+            # We *could* now fetch the remote refs and immediately update the local ones. However, then we would have to
+            # decide whether we want to allow a force-update or not. Also, the refs could already have changed remotely,
             # so that may update to some other commit.
             # Instead, we just fetch without updating any local ref. If the remote side changed in such a way that
-            # <newsha> is not actually fetched, that's a race and will be noticed when updating the local ref.
-            git.fetch(url, ref, capture_stderr = suppress_stderr)
-            # now update the ref, checking the old value is still local_oldsha.
-            git.update_ref(ref, newsha, 40*"0" if local_sha is None else local_sha)
+            # <remote_sha> is not actually fetched, that's a race and will be noticed when updating the local ref.
+            start = time.monotonic()
+            try:
+                progress = ['--progress'] if suppress_stderr and metrics.enabled() else []
+                (out, nbytes) = git_transfer(git_stream.fetch(*progress, url, *fetch_refs, capture_stderr = suppress_stderr))
+            except Exception:
+                metrics.observe('fetch', time.monotonic() - start, False, repo = self.name, mirror = mirror)
+                raise
+            metrics.observe('fetch', time.monotonic() - start, True, nbytes, repo = self.name, mirror = mirror)
+        still_waiting = {} # the superseded updates that did not happen locally yet
+        if superseded:
+            # Several updates of a ref came in while we were busy, and we only get to see the last one. The others must
+            # have happened before: Their new SHA has to be in the history of where the ref is now, locally or remotely.
+            missing = git_missing_objects(git, set(newsha for (ref, oldsha, newsha) in superseded) | set(remote_refs.values()))
+            checks = []
+            for (ref, oldsha, newsha) in superseded:
+                if newsha not in missing:
+                    checks.extend((newsha, sha) for sha in (local_refs[ref], remote_refs.get(ref, git_nullsha))
+                                  if sha != git_nullsha and sha not in missing)
+            forced = dict(zip(checks, git_forced_updates(git, checks)))
+            changed = set(change[0] for change in changes)
+            for (ref, oldsha, newsha) in superseded:
+                if not forced.get((newsha, local_refs[ref]), True):
+                    continue # we already have it
+                if forced.get((newsha, remote_refs.get(ref, git_nullsha)), True):
+                    failed[(ref, oldsha, newsha)] = "Someone lied about the new SHA of {}: {} is neither in the history of local ({}) nor remote ({}).".format(
+                        ref, newsha, local_refs[ref], remote_refs.get(ref, git_nullsha))
+                elif ref not in changed:
+                    note += "The mirror already moved {} past {}, waiting for the update to {}\n".format(ref, newsha, remote_refs[ref])
+                    still_waiting.setdefault(ref, []).append([oldsha, newsha, waiting_since.get((ref, oldsha, newsha), time.time())])
+        # forget about the waiting updates of the refs we looked at, unless they are still waiting
+        refs_waiting = dict((ref, shas) for (ref, shas) in waiting.get(mirror, {}).items() if ref not in updates_by_ref)
+        refs_waiting.update(still_waiting)
+        if refs_waiting == waiting.get(mirror, {}):
+            waiting = None # nothing to write
+        elif refs_waiting:
+            waiting[mirror] = refs_waiting
         else:
-            # ref does not exist anymore. delete it.
-            assert local_sha != git_nullsha, "Why didn't we bail out earlier if there is nothing to do...?"
-            git.update_ref("-d", ref, local_sha) # this checks that the old value is still local_sha
+            del waiting[mirror]
+        if not changes:
+            if waiting is not None:
+                Metrics.write_atomically(waiting_file, json.dumps(waiting))
+            return (note+"Local repository is already up-to-date.", failed, {})
+        # now update the refs (deleting those that do not exist anymore), checking the old value is still local_sha.
+        with metrics.time('update_ref', repo = self.name):
+            self.git_backend().update_refs([(ref, remote_sha, local_sha) for (ref, oldsha, local_sha, remote_sha) in changes])
+        if waiting is not None:
+            Metrics.write_atomically(waiting_file, json.dumps(waiting))
+        updated = dict((ref, (local_sha, remote_sha)) for (ref, oldsha, local_sha, remote_sha) in changes)
         # Now run the post-receive hooks. This will *also* push the changes to all mirrors, as we
         # are one of these hooks!
-        os.putenv("GIT_MIRROR_SOURCE", mirror) # tell ourselves which repo we do *not* have to update
-        with Popen_quirky(['hooks/post-receive'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as p:
-            (stdout, stderr) = p.communicate("{} {} {}\n".format(oldsha, newsha, ref).encode('utf-8'))
+        env = self.git_env(GIT_MIRROR_SOURCE = mirror) # tell ourselves which repo we do *not* have to update
+        with metrics.time('post_receive', repo = self.name), \
+             Popen_quirky([os.path.join(self.local, 'hooks', 'post-receive')], cwd=self.local, env=env,
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as p:
+            (stdout, stderr) = p.communicate(''.join("{} {} {}\n".format(oldsha, remote_sha, ref)
+                                                     for (ref, oldsha, local_sha, remote_sha) in changes).encode('utf-8'))
             stdout = stdout.decode('utf-8')
             if p.returncode:
                 raise Exception("post-receive git hook terminated with non-zero exit code {}:\n{}".format(p.returncode, stdout))
-        return stdout
+        return (note+stdout, failed, updated)
+
+class JobQueue:
+    '''A persistent queue of ref updates that still have to be synced, kept in an SQLite database. There are two kinds of
+       jobs: "push" jobs forward a local update to all mirrors except for the one given, and "fetch" jobs update the local
+       repository from the given mirror (and then the others, via the hooks). When several updates of the same ref are queued,
+       they are collapsed into one, from the oldest old SHA to the newest new SHA.'''
+    def __init__(self, filename):
+        import sqlite3
+        self.db = sqlite3.connect(filename, timeout = 60, isolation_level = None) # we do our own transactions
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, repo TEXT NOT NULL, kind TEXT NOT NULL, "
+                        "mirror TEXT NOT NULL, ref TEXT NOT NULL, oldsha TEXT NOT NULL, newsha TEXT NOT NULL, "
+                        "state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                        "not_before REAL NOT NULL DEFAULT 0, created REAL NOT NULL, last_error TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (repo, kind, mirror, ref, state)")
+    
+    def enqueue(self, repo, kind, ref, oldsha, newsha, mirror = None):
+        '''Add an update of <ref> in <repo> (a name) to the queue, or merge it into an update of the same ref that is still pending.'''
+        assert kind in ('push', 'fetch')
+        mirror = mirror or ''
+        with self.transaction():
+            pending = self.db.execute("SELECT id FROM jobs WHERE repo=? AND kind=? AND mirror=? AND ref=? AND state='pending'",
+                                      (repo, kind, mirror, ref)).fetchone()
+            if pending is None:
+                self.db.execute("INSERT INTO jobs (repo, kind, mirror, ref, oldsha, newsha, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (repo, kind, mirror, ref, oldsha, newsha, time.time()))
+            else:
+                # keep the old SHA (and the creation time) of the earlier update
+                self.db.execute("UPDATE jobs SET newsha=? WHERE id=?", (newsha, pending[0]))
+    
+    def claim(self):
+        '''Take the next batch of jobs that can run now: All pending updates of the same kind for the same repository and mirror.
+           Return a list of (id, repo, kind, mirror, ref, oldsha, newsha, attempts, created) tuples, which is empty if there is
+           nothing to do.'''
+        with self.transaction():
+            first = self.db.execute("SELECT repo, kind, mirror FROM jobs WHERE state='pending' AND not_before <= ? ORDER BY id LIMIT 1",
+                                    (time.time(),)).fetchone()
+            if first is None:
+                return []
+            jobs = self.db.execute("SELECT id, repo, kind, mirror, ref, oldsha, newsha, attempts, created FROM jobs WHERE state='pending' "
+                                   "AND not_before <= ? AND repo=? AND kind=? AND mirror=? ORDER BY id", (time.time(),)+first).fetchall()
+            self.db.executemany("UPDATE jobs SET state='running' WHERE id=?", ((job[0],) for job in jobs))
+            return jobs
+    
+    def finish(self, jobs):
+        '''Remove the given (successfully completed) jobs from the queue.'''
+        with self.transaction():
+            self.db.executemany("DELETE FROM jobs WHERE id=?", ((job[0],) for job in jobs))
+    
+    def fail(self, jobs, error, retry_delay):
+        '''Record that the given jobs failed with <error>. If <retry_delay> is None, give up on them; otherwise try them again
+           after that many seconds. A job that gets retried is merged with later updates of the same ref that got queued meanwhile.'''
+        with self.transaction():
+            for (id, repo, kind, mirror, ref, oldsha, newsha, attempts, created) in jobs:
+                if retry_delay is None:
+                    self.db.execute("UPDATE jobs SET state='failed', attempts=?, last_error=? WHERE id=?", (attempts+1, error, id))
+                    continue
+                later = self.db.execute("SELECT id FROM jobs WHERE repo=? AND kind=? AND mirror=? AND ref=? AND state='pending'",
+                                        (repo, kind, mirror, ref)).fetchone()
+                if later is None:
+                    self.db.execute("UPDATE jobs SET state='pending', attempts=?, not_before=?, last_error=? WHERE id=?",
+                                    (attempts+1, time.time()+retry_delay, error, id))
+                else:
+                    # the later update starts where this one started
+                    self.db.execute("UPDATE jobs SET oldsha=?, attempts=?, not_before=?, last_error=? WHERE id=?",
+                                    (oldsha, attempts+1, time.time()+retry_delay, error, later[0]))
+                    self.db.execute("DELETE FROM jobs WHERE id=?", (id,))
+    
+    def recover(self):
+        '''Put jobs that were running when a worker died back into the queue. Only call this when no worker is running.'''
+        with self.transaction():
+            self.db.execute("UPDATE jobs SET state='pending' WHERE state='running'")
+    
+    def pending_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state != 'failed'").fetchone()[0]
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Run the body of the with-statement in an immediate transaction.'''
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+def open_queue():
+    '''Open the job queue in the state directory. Return None if the queue is not enabled.'''
+    if not use_queue:
+        return None
+    os.makedirs(state_dir, mode = 0o700, exist_ok = True)
+    return JobQueue(os.path.join(state_dir, 'queue.sqlite'))
 
 def find_repo_by_directory(repos, dir):
     for (name, repo) in repos.items():
@@ -201,14 +1746,93 @@ def find_repo_by_directory(repos, dir):
             return name
     return None
 
-def load_repos():
-    global mail_sender
+def load_config_snapshot():
+    '''Return a snapshot of the configuration: A dict with the options outside of any section ("defaults"), the repository
+       sections including these defaults ("repos"), and indexes mapping local directories to repository names ("by_local")
+       and mirror URLs to pairs of a repository name and a mirror ("by_url"). The snapshot is cached next to the
+       configuration file, and rebuilt whenever the configuration file changes.'''
+    with metrics.time('config_load'):
+        return read_config_snapshot()
+
+def read_config_snapshot():
+    st = os.stat(config_file)
+    source = [config_file, st.st_mtime_ns, st.st_size, st.st_ino]
+    snapshot_file = config_file+'.snapshot'
+    try:
+        with open(snapshot_file) as f:
+            snapshot = json.load(f)
+        if snapshot['source'] == source:
+            return snapshot
+    except (OSError, ValueError, KeyError):
+        pass # no usable snapshot
+    # (re)build the snapshot
     conf = read_config()
-    mail_sender = conf['DEFAULT']['mail-sender']
-    
-    repos = {}
+    snapshot = { 'source': source, 'defaults': dict(conf['DEFAULT']), 'repos': {}, 'by_local': {}, 'by_url': {} }
     for name, section in conf.items():
-        if name != 'DEFAULT':
-            repos[name] = Repo(name, section)
+        if name == 'DEFAULT': continue
+        snapshot['repos'][name] = dict(section)
+        snapshot['by_local'][section['local']] = name
+        for mirror, url in config_mirrors(section):
+            snapshot['by_url'][url] = [name, mirror]
+    try:
+        # the configuration contains secrets, so make sure nobody else can read the snapshot
+        tmp_file = "{}.{}.tmp".format(snapshot_file, os.getpid())
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, snapshot_file)
+    except OSError:
+        pass # we can work without the snapshot
+    return snapshot
+
+def load_defaults(snapshot):
+    '''Set up the global options from the given configuration snapshot.'''
+    global mail_sender, mail_smtp, mail_spool, mail_dedup_window, state_dir, use_queue
+    defaults = snapshot['defaults']
+    mail_sender = defaults['mail-sender']
+    mail_smtp = defaults.get('mail-smtp', 'localhost')
+    mail_spool = defaults.get('mail-spool', 'no') == 'yes'
+    mail_dedup_window = float(defaults.get('mail-dedup-window', '3600'))
+    state_dir = os.path.abspath(defaults.get('state-dir', os.path.join(os.path.dirname(config_file), 'state')))
+    use_queue = defaults.get('queue', 'no') == 'yes'
+    if metrics.textfile is None and metrics.logfile is None and ('metrics-textfile' in defaults or 'metrics-log' in defaults):
+        import atexit
+        atexit.register(metrics.flush)
+    metrics.textfile = defaults.get('metrics-textfile')
+    metrics.logfile = defaults.get('metrics-log')
+
+def load_repos():
+    '''Load all repositories. Return a dict mapping their names to Repo objects.'''
+    snapshot = load_config_snapshot()
+    load_defaults(snapshot)
+    repos = {}
+    for name, section in snapshot['repos'].items():
+        repos[name] = Repo(name, section)
     return repos
 
+def load_repo(name):
+    '''Load just the repository with the given name. Return None if there is no such repository.'''
+    snapshot = load_config_snapshot()
+    load_defaults(snapshot)
+    if name not in snapshot['repos']:
+        return None
+    return Repo(name, snapshot['repos'][name])
+
+def load_repo_by_directory(dir):
+    '''Load just the repository stored locally in <dir>. Return None if there is no such repository.'''
+    snapshot = load_config_snapshot()
+    load_defaults(snapshot)
+    name = snapshot['by_local'].get(dir)
+    if name is None:
+        return None
+    return Repo(name, snapshot['repos'][name])
+
+def load_repo_by_mirror_url(match_urls):
+    '''Load just the repository having a mirror with one of the given URLs. Return a pair of the Repo and the name of the
+       mirror, or (None, None) if there is no such repository.'''
+    snapshot = load_config_snapshot()
+    load_defaults(snapshot)
+    for url in match_urls:
+        if url in snapshot['by_url']:
+            (name, mirror) = snapshot['by_url'][url]
+            return (Repo(name, snapshot['repos'][name]), mirror)
+    return (None, None)
@@ -30,22 +30,30 @@ from git_mirror import *
 if __name__ == "__main__":
     repo = None # we will try to use this during exception handling
     try:
-        repos = load_repos()
-        
         # find the repository we are dealing with
-        reponame = find_repo_by_directory(repos, os.getcwd())
-        if reponame is None or reponame not in repos:
-            raise Exception("Unknown repository {}.".format(reponame))
+        repo = load_repo_by_directory(os.getcwd())
+        if repo is None:
+            raise Exception("Unknown repository {}.".format(os.getcwd()))
         
         # now sync this repository
-        repo = repos[reponame]
         # parse the information we get from stdin. we trust this information.
+        updates = []
         for line in sys.stdin:
             line = line.split()
             if len(line) == 0: continue
             assert len(line) == 3
             (oldsha, newsha, ref) = line
-            repo.update_mirrors(ref, oldsha, newsha)
+            updates.append((ref, oldsha, newsha))
+        queue = open_queue()
+        if queue is not None:
+            # let the queue worker do the pushing
+            for (ref, oldsha, newsha) in updates:
+                queue.enqueue(repo.name, 'push', ref, oldsha, newsha, mirror = os.getenv("GIT_MIRROR_SOURCE"))
+            sys.stdout.write("Queued update of {} ref(s) for the mirrors\n".format(len(updates)))
+        else:
+            # push all the refs to each mirror at once
+            with metrics.time('hook', repo = repo.name):
+                repo.update_mirrors_batch(updates)
     except Exception as e:
         if repo is not None:
             repo.mail_owner("There was a problem running the git-mirror git hook:\n\n{}".format(traceback.format_exc()))
@@ -1,6 +1,6 @@
 #!/usr/bin/python3
-import random, string, argparse, os.path, subprocess, shutil
-import requests, json
+import random, string, argparse, os.path, subprocess, shutil, concurrent.futures, traceback
+import requests, requests.adapters, json
 from git_mirror import *
 
 def random_string(length):
@@ -11,18 +11,79 @@ def random_string(length):
         result += r.choice(alphabet)
     return result
 
-def generate_ssh_key(name, bits):
-    subprocess.check_call(["ssh-keygen", "-f", name, "-C", name, "-b", str(bits), "-q", "-N", ""])
+def generate_ssh_key(name, key_type):
+    if os.path.exists(name):
+        raise Exception("The key {} already exists.".format(name))
+    bits = ["-b", str(4*1024)] if key_type == "rsa" else []
+    subprocess.check_call(["ssh-keygen", "-t", key_type, "-f", name, "-C", name, "-q", "-N", ""] + bits, stdin=subprocess.DEVNULL)
 
-def add_deploy_key(key_name, repo_owner, repo_name, access_token):
-    url = "https://api.github.com/repos/{owner}/{repo}/keys".format(owner=repo_owner, repo=repo_name)
-    data = { 'title': os.path.basename(key_name), 'key': open(key_name+".pub").read() }
-    r = requests.post(url, data=json.dumps(data), headers = {"Authorization": "token {token}".format(token=access_token)})
-    if r.status_code >= 300:
-        raise Exception(str(json.loads(r.content.decode('utf-8'))))
-    
-def add_web_hook(webhook_url, hmac_secret, repo_owner, repo_name, access_token):
-    url = 'https://api.github.com/repos/{owner}/{repo}/hooks'.format(owner=repo_owner, repo=repo_name)
+class GitHub:
+    '''Talks to the GitHub API at <api_url>, re-using connections, and waiting when we hit the rate limit.'''
+    def __init__(self, api_url, access_token, connections, max_attempts = 5):
+        self.api_url = api_url.rstrip('/')
+        self.max_attempts = max_attempts
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": "token {token}".format(token=access_token),
+                                     "Accept": "application/vnd.github+json"})
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, data = None):
+        '''Send a request, retrying when GitHub has trouble or we hit the rate limit. Return the response, or None if we
+           retried a POST and GitHub says that the thing we tried to create already exists: the earlier attempt
+           created it after all.'''
+        server_error = False
+        for attempt in range(self.max_attempts):
+            r = self.session.request(method, self.api_url+path, data=None if data is None else json.dumps(data))
+            if r.status_code < 300:
+                return r
+            if method == 'POST' and server_error and r.status_code == 422 and 'already' in r.text:
+                return None
+            if attempt+1 == self.max_attempts:
+                break
+            if r.status_code in (403, 429) and (r.headers.get('Retry-After') or r.headers.get('X-RateLimit-Remaining') == '0'):
+                # rate limited: GitHub tells us how long to wait, one way or the other
+                if r.headers.get('Retry-After'):
+                    delay = float(r.headers['Retry-After'])
+                else:
+                    delay = float(r.headers.get('X-RateLimit-Reset', time.time()+60)) - time.time()
+                time.sleep(max(1, delay) + random.uniform(0, 1))
+            elif r.status_code >= 500:
+                server_error = True
+                time.sleep(2**attempt + random.uniform(0, 1))
+            else:
+                break
+        raise Exception("{} {} failed with status {}: {}".format(method, path, r.status_code, r.content.decode('utf-8')))
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, data):
+        return self.request('POST', path, data)
+
+    def delete(self, path):
+        return self.request('DELETE', path)
+
+def add_deploy_key(github, key_name, repo_owner, repo_name):
+    path = "/repos/{owner}/{repo}/keys".format(owner=repo_owner, repo=repo_name)
+    data = { 'title': os.path.basename(key_name), 'key': open(key_name+".pub").read(), 'read_only': False }
+    r = github.post(path, data)
+    if r is not None:
+        return r.json()['id']
+    # an earlier attempt added the key after all, find it (GitHub does not keep the comment)
+    key = data['key'].split()[:2]
+    for deploy_key in github.get(path+"?per_page=100").json():
+        if deploy_key['key'].split()[:2] == key:
+            return deploy_key['id']
+    raise Exception("GitHub says the deploy key {} is already in use, but it is not a deploy key of {}/{}".format(key_name, repo_owner, repo_name))
+
+def remove_deploy_key(github, key_id, repo_owner, repo_name):
+    path = "/repos/{owner}/{repo}/keys/{id}".format(owner=repo_owner, repo=repo_name, id=key_id)
+    github.delete(path)
+
+def add_web_hook(github, webhook_url, hmac_secret, repo_owner, repo_name):
+    path = '/repos/{owner}/{repo}/hooks'.format(owner=repo_owner, repo=repo_name)
     data = {
         'name': "web",
         'active': True,
@@ -33,9 +94,51 @@ def add_web_hook(webhook_url, hmac_secret, repo_owner, repo_name, access_token):
             'secret': hmac_secret,
         }
     }
-    r = requests.post(url, data=json.dumps(data), headers = {"Authorization": "token {token}".format(token=access_token)})
-    if r.status_code >= 300:
-        raise Exception(str(json.loads(r.content.decode('utf-8'))))
+    github.post(path, data)
+
+def read_manifest(filename):
+    '''Read a manifest with one repository per line: The owner on GitHub, the e-mail address to notify, the local directory
+       and (optionally) the name on GitHub, separated by whitespace. Empty lines and lines starting with # are ignored.'''
+    repos = []
+    with open(filename) as f:
+        for (number, line) in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) not in (3, 4):
+                raise Exception("{}:{}: Expected owner, e-mail address, local directory and optionally the name".format(filename, number))
+            repos.append(tuple(fields) + (None,)*(4-len(fields)))
+    return repos
+
+def setup_repo(github, key_type, owner, email, local, name):
+    '''Create the deploy key and the webhook for one repository. Return the configuration section for it.'''
+    hmac_secret = random_string(64)
+    ssh_deploy_key = os.path.join(os.path.expanduser('~/.ssh'), name+"-github")
+    generate_ssh_key(ssh_deploy_key, key_type)
+    try:
+        key_id = add_deploy_key(github, ssh_deploy_key, owner, name)
+    except Exception:
+        # nobody knows about the key, so we can try again later
+        os.remove(ssh_deploy_key)
+        os.remove(ssh_deploy_key+".pub")
+        raise
+    try:
+        add_web_hook(github, webhook_url+"?repository="+name, hmac_secret, owner, name)
+    except Exception:
+        # take the key back, so that we can start over later
+        try:
+            remove_deploy_key(github, key_id, owner, name)
+        except Exception as e:
+            sys.stderr.write("Could not remove the deploy key {} from {}/{}, please do that manually: {}\n".format(os.path.basename(ssh_deploy_key), owner, name, e))
+        os.remove(ssh_deploy_key)
+        os.remove(ssh_deploy_key+".pub")
+        raise
+    return ('\n[{}]\n'.format(name) +
+            'owner={}\n'.format(email) +
+            'local={}\n'.format(local) +
+            'deploy-key={}\n'.format(os.path.basename(ssh_deploy_key)) +
+            'hmac-secret={}\n'.format(hmac_secret) +
+            'mirror-github=git@github.com:{}/{}.git\n'.format(owner, name))
 
 # get config and user arguments
 conf = read_config()
@@ -52,34 +155,62 @@ parser.add_argument("-l", "--local",
 parser.add_argument("-n", "--name",
                     dest="name", default=None,
                     help="The name of the repository on GitHub (defaults to the basename of the local directory)")
+parser.add_argument("-m", "--manifest",
+                    dest="manifest", default=None,
+                    help="Set up all the repositories listed in this file (one per line: owner, e-mail, local directory and optionally name)")
+parser.add_argument("-t", "--key-type",
+                    dest="key_type", default="rsa", choices=["rsa", "ed25519", "ecdsa"],
+                    help="The type of the deploy keys to generate (default: rsa, with 4096 bits)")
+parser.add_argument("-j", "--jobs",
+                    dest="jobs", type=int, default=8,
+                    help="How many repositories to set up at the same time (default: 8)")
 args = parser.parse_args()
-args.local = os.path.abspath(args.local)
-assert os.path.isdir(args.local), "Local repository has to be a directory"
-if args.name is None:
-    args.name = os.path.basename(args.local)
-    if args.name.endswith(".git"):
-        args.name = args.name[:-4]
-hmac_secret = random_string(64)
-ssh_deploy_key = os.path.join(os.path.expanduser('~/.ssh'), args.name+"-github")
+if args.manifest is not None:
+    repos = read_manifest(args.manifest)
+else:
+    assert args.owner and args.email and args.local, "Owner, e-mail address and local directory are needed"
+    repos = [(args.owner, args.email, args.local, args.name)]
+todo = []
+for (owner, email, local, name) in repos:
+    local = os.path.abspath(local)
+    assert os.path.isdir(local), "Local repository {} has to be a directory".format(local)
+    if name is None:
+        name = os.path.basename(local)
+        if name.endswith(".git"):
+            name = name[:-4]
+    assert not conf.has_section(name) and name not in (todo_name for (o, e, l, todo_name) in todo), \
+        "Repository {} is already configured".format(name)
+    todo.append((owner, email, local, name))
 github_token = conf['DEFAULT']['github-token']
 webhook_url = conf['DEFAULT']['webhook-url']
+github = GitHub(conf['DEFAULT'].get('github-api', 'https://api.github.com'), github_token, max(1, args.jobs))
 
-# append to the configuration (after making a backup)
-shutil.copy(config_file, config_file+".bak")
-with open(config_file, 'a') as f:
-    f.write('\n[{}]\n'.format(args.name))
-    f.write('owner={}\n'.format(args.email))
-    f.write('local={}\n'.format(args.local))
-    f.write('deploy-key={}\n'.format(os.path.basename(ssh_deploy_key)))
-    f.write('hmac-secret={}\n'.format(hmac_secret))
-    f.write('mirror-github=git@github.com:{}/{}.git\n'.format(args.owner, args.name))
-
-try:
-    generate_ssh_key(ssh_deploy_key, 4*1024)
-    add_deploy_key(ssh_deploy_key, args.owner, args.name, github_token)
-    add_web_hook(webhook_url+"?repository="+args.name, hmac_secret, args.owner, args.name, github_token)
-    print("Done! Your GitHub repository is set up.\nRemember to configure the git-mirror hook for the local repository {}, e.g. in your gitolite configuration!".format(args.local))
-except Exception as E:
-    shutil.copy(config_file+".bak", config_file)
-    raise
+# set up all the repositories (ssh-keygen and the requests run concurrently in the threads)
+sections = {}
+failed = []
+with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, args.jobs)) as executor:
+    futures = dict((executor.submit(setup_repo, github, args.key_type, *repo), repo) for repo in todo)
+    for future in concurrent.futures.as_completed(futures):
+        (owner, email, local, name) = futures[future]
+        try:
+            sections[name] = future.result()
+            print("Set up {}/{}".format(owner, name))
+        except Exception:
+            failed.append(name)
+            sys.stderr.write("Failed to set up {}/{}:\n{}".format(owner, name, traceback.format_exc()))
 
+# add all the new repositories to the configuration at once (after making a backup)
+if sections:
+    shutil.copy(config_file, config_file+".bak")
+    with open(config_file) as f:
+        config = f.read()
+    with open(config_file+".tmp", 'w') as f:
+        f.write(config)
+        for (owner, email, local, name) in todo:
+            if name in sections:
+                f.write(sections[name])
+    shutil.copymode(config_file, config_file+".tmp")
+    os.replace(config_file+".tmp", config_file)
+if failed:
+    sys.exit("Setting up {} repositories failed: {}".format(len(failed), ', '.join(sorted(failed))))
+print("Done! Your GitHub repositories are set up.\nRemember to configure the git-mirror hook for the local repositories, e.g. in your gitolite configuration!")
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015, Ralf Jung <post@ralfj.de>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer. 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+
+# This sends the mails that git-mirror puts into its spool when "mail-spool = yes" is set in the configuration. The
+# hooks start it with --once whenever they spool a mail. To also get the digests for errors that happened again within
+# the deduplication window, run it from cron, or without --once as a system service.
+import traceback, argparse
+from git_mirror import *
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Send the mails spooled by git-mirror')
+    parser.add_argument("--once",
+                        action="store_true", dest="once",
+                        help="Exit after sending what is in the spool, instead of waiting for more mails")
+    parser.add_argument("--interval",
+                        type=float, default=60,
+                        help="How many seconds to wait before looking at the spool again (default: 60)")
+    args = parser.parse_args()
+    
+    while True:
+        load_defaults(load_config_snapshot())
+        try:
+            process_mail_spool()
+        except Exception as e:
+            # the mails stay in the spool, we will try again next time
+            if args.once:
+                raise
+            sys.stderr.write("git-mirror: We have a problem:\n{}".format('\n'.join(traceback.format_exception_only(type(e), e))))
+        if args.once:
+            break
+        time.sleep(args.interval)
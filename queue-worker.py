@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015, Ralf Jung <post@ralfj.de>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer. 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+
+# This is the worker processing the job queue that githook.py and the webhooks fill when "queue = yes" is set in the
+# configuration. Run it as the git user, e.g. as a system service. Send SIGHUP to make it re-read the configuration.
+import traceback, argparse, signal
+from git_mirror import *
+
+def process(repo, jobs):
+    '''Run a batch of jobs, as returned by JobQueue.claim.'''
+    (id, reponame, kind, mirror, ref, oldsha, newsha, attempts, created) = jobs[0]
+    if kind == 'push':
+        repo.update_mirrors_batch([(ref, oldsha, newsha) for (id, reponame, kind, mirror, ref, oldsha, newsha, attempts, created) in jobs],
+                                  source_mirror = mirror)
+    else:
+        with repo.lock():
+            (output, failed, updated) = repo.update_refs_from_mirror([(ref, oldsha, newsha) for (id, reponame, kind, mirror, ref, oldsha, newsha, attempts, created) in jobs],
+                                                                     mirror, suppress_stderr = True)
+        sys.stdout.write(output+"\n")
+        if failed:
+            raise Exception('\n'.join(failed.values()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Process the git-mirror job queue')
+    parser.add_argument("--once",
+                        action="store_true", dest="once",
+                        help="Exit when the queue is empty, instead of waiting for more jobs")
+    args = parser.parse_args()
+    
+    reload = True
+    def request_reload(signum, frame):
+        global reload
+        reload = True
+    signal.signal(signal.SIGHUP, request_reload)
+    
+    queue = None
+    repos = {}
+    while True:
+        if reload:
+            reload = False
+            for repo in repos.values():
+                repo.close()
+            repos = load_repos()
+            conf = read_config()['DEFAULT']
+            poll_interval = float(conf.get('queue-poll-interval', '5'))
+            retry_delay = float(conf.get('queue-retry-delay', '60'))
+            retry_max_delay = float(conf.get('queue-retry-max-delay', '3600'))
+            max_attempts = int(conf.get('queue-max-attempts', '10'))
+            if queue is None:
+                queue = open_queue()
+                if queue is None:
+                    raise Exception("The queue is not enabled in the configuration.")
+                queue.recover() # put back whatever a previous worker did not finish
+        jobs = queue.claim()
+        metrics.set('git_mirror_queue_depth', queue.pending_count())
+        metrics.flush()
+        if not jobs:
+            if args.once:
+                break
+            time.sleep(poll_interval)
+            continue
+        (id, reponame, kind, mirror, ref, oldsha, newsha, attempts, created) = jobs[0]
+        repo = repos.get(reponame)
+        try:
+            if repo is None:
+                raise Exception("Unknown repository {}.".format(reponame))
+            process(repo, jobs)
+            queue.finish(jobs)
+            for job in jobs:
+                # how long it took from the update being queued until it got to all the mirrors
+                metrics.observe_histogram('git_mirror_propagation_seconds', time.time() - job[-1], repo = reponame, kind = kind)
+        except Exception as e:
+            attempts = max(job[7] for job in jobs)
+            give_up = repo is None or attempts+1 >= max_attempts
+            queue.fail(jobs, traceback.format_exc(), None if give_up else min(retry_max_delay, retry_delay * 2**attempts))
+            if repo is not None and (attempts == 0 or give_up):
+                repo.mail_owner("There was a problem running the git-mirror queue worker{}:\n\n{}".format(
+                    " (giving up)" if give_up else " (will retry)", traceback.format_exc()))
+            sys.stderr.write("git-mirror: We have a problem:\n{}".format('\n'.join(traceback.format_exception_only(type(e), e))))
+        sys.stdout.flush()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015, Ralf Jung <post@ralfj.de>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer. 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+
+# This brings the mirrors of some or all repositories back in sync with the local repositories, e.g. after an outage.
+# Only the refs that differ are pushed. Different repositories are processed in parallel.
+import traceback, argparse, concurrent.futures
+from git_mirror import *
+
+def reconcile(repo, mirrors, dry_run, progress, catch_up, overwrite):
+    '''Run in a worker thread: Reconcile one repository (or just catch up on what its mirrors missed while they were down).
+       Returns a pair of a success flag and the report.'''
+    last = {}
+    def report_progress(mirror, phase, percent):
+        # tell about every 10%, that is enough to see that something is happening
+        if last.get(mirror) != (phase, percent // 10):
+            last[mirror] = (phase, percent // 10)
+            sys.stderr.write("{}: {}: {} {}%\n".format(repo.name, mirror, phase, percent))
+    try:
+        if catch_up:
+            repo.catch_up() # this reports on stdout
+            return (True, '')
+        return (True, '\n'.join(repo.reconcile(mirrors, dry_run = dry_run, report_progress = report_progress if progress else None,
+                                                overwrite = overwrite)))
+    except Exception:
+        return (False, traceback.format_exc())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Push everything that is missing on the mirrors')
+    parser.add_argument("-n", "--dry-run",
+                        action="store_true", dest="dry_run",
+                        help="Only report what would be pushed")
+    parser.add_argument("-m", "--mirror",
+                        action="append", dest="mirrors",
+                        help="Only reconcile this mirror (can be given several times)")
+    parser.add_argument("-p", "--progress",
+                        action="store_true", dest="progress",
+                        help="Show the progress of the pushes")
+    parser.add_argument("-c", "--catch-up",
+                        action="store_true", dest="catch_up",
+                        help="Only push the updates that mirrors missed while they were down, if they are back")
+    parser.add_argument("--overwrite",
+                        action="store_true", dest="overwrite",
+                        help="Also rewind refs the mirrors have moved ahead of the local repository, and delete refs only they have")
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs", type=int, default=4,
+                        help="How many repositories to process at the same time (default: 4)")
+    parser.add_argument("repos", metavar="REPO", nargs="*",
+                        help="The repositories to reconcile (default: all)")
+    args = parser.parse_args()
+    
+    repos = load_repos()
+    for reponame in args.repos:
+        if reponame not in repos:
+            raise Exception("Repository {} missing or not found.".format(reponame))
+    names = args.repos or sorted(repos.keys())
+    ok = True
+    # Repo operations do not touch the current directory or environment of our process, so threads can work on different
+    # repositories at the same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, args.jobs)) as executor:
+        futures = []
+        for name in names:
+            mirrors = None if args.mirrors is None else [mirror for mirror in args.mirrors if mirror in repos[name].mirrors]
+            futures.append(executor.submit(reconcile, repos[name], mirrors, args.dry_run, args.progress, args.catch_up, args.overwrite))
+        for future in concurrent.futures.as_completed(futures):
+            (success, report) = future.result()
+            if success:
+                if report:
+                    print(report)
+            else:
+                ok = False
+                sys.stderr.write(report)
+            sys.stdout.flush()
+    sys.exit(0 if ok else 1)
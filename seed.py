@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015, Ralf Jung <post@ralfj.de>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer. 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+
+# This seeds new mirrors with the full content of a repository. Instead of one huge push, which has to start over when it
+# fails, the history is pushed in chunks and the refs in batches; running it again after an interruption continues where
+# it stopped.
+import argparse
+from git_mirror import *
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Push everything to new mirrors, in chunks')
+    parser.add_argument("-c", "--chunk",
+                        dest="chunk", type=int, default=None,
+                        help="How many commits of the first-parent history to push at once (default: seed-chunk from the configuration)")
+    parser.add_argument("repo", metavar="REPO",
+                        help="The repository to seed the mirrors of")
+    parser.add_argument("mirrors", metavar="MIRROR", nargs="+",
+                        help="The mirrors to seed")
+    args = parser.parse_args()
+    
+    repo = load_repo(args.repo)
+    if repo is None:
+        raise Exception("Repository {} missing or not found.".format(args.repo))
+    for mirror in args.mirrors:
+        if mirror not in repo.mirrors:
+            raise Exception("Repository {} has no mirror {}.".format(repo.name, mirror))
+    ok = True
+    for mirror in args.mirrors:
+        def report(line):
+            sys.stdout.write("{}: {}: {}\n".format(repo.name, mirror, line))
+            sys.stdout.flush()
+        try:
+            repo.seed(mirror, args.chunk, report)
+        except Exception as e:
+            ok = False
+            sys.stderr.write("{}: {}: {}\nRun this again to continue where it stopped.\n".format(repo.name, mirror, e))
+    sys.exit(0 if ok else 1)
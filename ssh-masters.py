@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015, Ralf Jung <post@ralfj.de>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer. 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+
+# This lists the SSH master connections git-mirror keeps open when "ssh-multiplex = yes" is set, and removes the sockets
+# of masters that are gone. With --stop, it also shuts down the masters that are still running.
+import argparse
+from git_mirror import *
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Manage the SSH master connections of git-mirror')
+    parser.add_argument("--stop",
+                        action="store_true", dest="stop",
+                        help="Shut down all the master connections")
+    args = parser.parse_args()
+    
+    repos = load_repos()
+    # collect the places where the sockets are, and how to talk to them
+    control_dirs = {}
+    for repo in repos.values():
+        control_dirs[repo.ssh_control_dir] = repo.ssh_command
+    for (control_dir, ssh_command) in sorted(control_dirs.items()):
+        for socket in ssh_control_sockets(control_dir):
+            if not ssh_control_check(ssh_command, socket):
+                os.unlink(socket)
+                print("{}: stale, removed".format(socket))
+            elif args.stop:
+                ssh_control_check(ssh_command, socket, 'exit')
+                print("{}: stopped".format(socket))
+            else:
+                print("{}: running".format(socket))
@@ -23,6 +23,12 @@
 #==============================================================================
 
 # This sets the SSH identitiy based on an environment variable. That makes it possible for the git-mirror
-# scripts to use git with a particular SSH identity.
+# scripts to use git with a particular SSH identity. If GIT_MIRROR_SSH_CONTROL_PATH is set, connections
+# are shared via the master connections git-mirror manages there.
 
-exec ssh -i "$GIT_MIRROR_SSH_IDENT" "$@"
+SSH="${GIT_MIRROR_SSH_COMMAND:-ssh}"
+if [ -n "$GIT_MIRROR_SSH_CONTROL_PATH" ]; then
+    exec "$SSH" -i "$GIT_MIRROR_SSH_IDENT" -o ControlMaster=auto -o "ControlPath=$GIT_MIRROR_SSH_CONTROL_PATH" \
+        -o "ControlPersist=${GIT_MIRROR_SSH_CONTROL_PERSIST:-60}" "$@"
+fi
+exec "$SSH" -i "$GIT_MIRROR_SSH_IDENT" "$@"
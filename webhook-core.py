@@ -24,35 +24,26 @@
 #==============================================================================
 
 # This is the hook called by GitHub as webhook. It updats the local repository, and then all the other mirrors.
-import sys, traceback, json
+import sys, traceback
 from git_mirror import *
 
 def get_github_payload(repo, signature):
     '''Return the github-style JSON encoded payload (as if we were called as a github webhook)'''
-    data = sys.stdin.buffer.read()
-    verify_signature = repo.compute_hmac(data)
-    if signature != "sha1="+verify_signature:
-        raise Exception("You are not GitHub!")
-    try:
-        data = json.loads(data.decode('utf-8'))
-        return data
-    except ValueError:
-        return {} # nothing read
+    return repo.parse_github_payload(sys.stdin.buffer.read(), signature)
 
 
 if __name__ == "__main__":
     # call this with: <reponame> <event name> <signature>
     repo = None # we will try to use this during exception handling
     try:
-        repos = load_repos()
         if len(sys.argv) < 4:
             raise Exception("Usage: {} <reponame> <event name> <signature>".format(os.path.basename(sys.argv[0])))
         reponame = sys.argv[1]
         githubEvent = sys.argv[2]
         githubSignature = sys.argv[3]
-        if reponame not in repos:
+        repo = load_repo(reponame)
+        if repo is None:
             raise Exception("Repository {} missing or not found.".format(reponame))
-        repo = repos[reponame]
         
         # now sync this repository
         data = get_github_payload(repo, githubSignature)
@@ -63,25 +54,26 @@ if __name__ == "__main__":
             print("Pong!")
             sys.exit(0)
         elif githubEvent == 'push':
-            ref = data["ref"]
-            oldsha = data["before"]
-            newsha = data["after"]
-            # validate the ref name
-            if re.match('refs/[a-z/]+', ref) is None:
-                raise Exception("Invalid ref name {}".format(ref))
-            # collect URLs of this repository, to find the mirror name
-            urls = []
-            for key in ("git_url", "ssh_url", "clone_url"):
-                urls.append(data["repository"][key])
-            mirror = repo.find_mirror_by_url(urls)
-            if mirror is None:
-                raise Exception("Could not find the mirror.")
-            stdout = repo.update_ref_from_mirror(ref, oldsha, newsha, mirror, suppress_stderr = True)
-            # print an answer
-            print("Content-Type: text/plain")
-            print()
-            print("Updated {}:{} from mirror {} from {} to {}".format(reponame, ref, mirror, oldsha, newsha))
-            print(stdout)
+            queue = open_queue()
+            if queue is not None:
+                # let the queue worker do the work, so that GitHub does not have to wait
+                (ref, oldsha, newsha, mirror) = repo.github_push_update(data)
+                if not repo.wants_ref(mirror, ref):
+                    print("Content-Type: text/plain")
+                    print()
+                    print("Not syncing {}:{} from mirror {} (filtered)".format(reponame, ref, mirror))
+                    sys.exit(0)
+                queue.enqueue(repo.name, 'fetch', ref, oldsha, newsha, mirror = mirror)
+                print("Status: 202 Accepted")
+                print("Content-Type: text/plain")
+                print()
+                print("Queued update of {}:{} from mirror {} from {} to {}".format(reponame, ref, mirror, oldsha, newsha))
+            else:
+                result = repo.update_from_github_push(data)
+                # print an answer
+                print("Content-Type: text/plain")
+                print()
+                print(result)
         else:
             raise Exception("Unexpected github event {}.".format(githubEvent))
     except Exception as e:
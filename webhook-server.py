@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015, Ralf Jung <post@ralfj.de>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer. 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#==============================================================================
+
+# This is a resident HTTP server receiving GitHub webhooks. It replaces webhook.py and webhook-core.py: It runs as the git
+# user, keeps the configuration loaded and handles deliveries using a pool of worker threads, so that no new interpreter
+# has to be started for every request. Send SIGHUP to make it re-read the configuration.
+import traceback, argparse, signal, threading, urllib.parse, http.server, concurrent.futures
+from git_mirror import *
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, address, workers):
+        super().__init__(address, WebhookHandler)
+        self.workers = workers
+        self.load()
+    
+    def load(self):
+        '''(Re-)load the configuration, and start a fresh pool of workers using it.'''
+        old_repos = getattr(self, 'repos', {})
+        self.repos = load_repos()
+        old_pool = getattr(self, 'pool', None)
+        # Repo operations do not touch the current directory or environment of our process, so different repositories can
+        # be handled in threads at the same time
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers)
+        if old_pool is not None:
+            # let the old workers finish, then stop the git processes they used
+            old_pool.shutdown(wait = True)
+        for repo in old_repos.values():
+            repo.close()
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def reply(self, code, text):
+        data = (text+"\n").encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_GET(self):
+        self.reply(405, "git-mirror: This is a webhook, please POST.")
+    
+    def do_POST(self):
+        repo = None # we will try to use this during exception handling
+        try:
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            reponame = query.get('repository', [''])[0]
+            githubEvent = self.headers.get('X-GitHub-Event')
+            githubSignature = self.headers.get('X-Hub-Signature', '')
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            repos = self.server.repos # the configuration might get reloaded while we are working
+            if reponame not in repos:
+                raise Exception("Repository {} missing or not found.".format(reponame))
+            repo = repos[reponame]
+            
+            # now sync this repository
+            data = repo.parse_github_payload(data, githubSignature)
+            if githubEvent == 'ping':
+                # github sends this initially
+                self.reply(200, "Pong!")
+            elif githubEvent == 'push':
+                queue = open_queue()
+                if queue is not None:
+                    # let the queue worker do the work, so that GitHub does not have to wait
+                    (ref, oldsha, newsha, mirror) = repo.github_push_update(data)
+                    if not repo.wants_ref(mirror, ref):
+                        self.reply(200, "Not syncing {}:{} from mirror {} (filtered)".format(repo.name, ref, mirror))
+                        return
+                    queue.enqueue(repo.name, 'fetch', ref, oldsha, newsha, mirror = mirror)
+                    self.reply(202, "Queued update of {}:{} from mirror {} from {} to {}".format(repo.name, ref, mirror, oldsha, newsha))
+                    return
+                # result() re-raises whatever went wrong in the worker, with the traceback
+                self.reply(200, self.server.pool.submit(repo.update_from_github_push, data).result())
+            else:
+                raise Exception("Unexpected github event {}.".format(githubEvent))
+        except Exception as e:
+            details = traceback.format_exc()
+            # do not print all the details, and do not keep GitHub waiting for the mail
+            self.reply(500, "git-mirror: We have a problem:\n{}".format('\n'.join(traceback.format_exception_only(type(e), e))))
+            if repo is not None:
+                try:
+                    repo.mail_owner("There was a problem running the git-mirror webhook:\n\n{}".format(details))
+                except Exception:
+                    sys.stderr.write("Could not mail the owner of {} about this:\n{}\nbecause of:\n{}".format(repo.name, details, traceback.format_exc()))
+        finally:
+            metrics.flush()
+
+if __name__ == "__main__":
+    conf = read_config()['DEFAULT']
+    parser = argparse.ArgumentParser(description='Receive GitHub webhooks and sync the repositories')
+    parser.add_argument("-l", "--listen",
+                        dest="listen", default=conf.get('webhook-listen', 'localhost'),
+                        help="The address to listen on (default: localhost)")
+    parser.add_argument("-p", "--port",
+                        dest="port", type=int, default=int(conf.get('webhook-port', '8008')),
+                        help="The port to listen on (default: 8008)")
+    parser.add_argument("-w", "--workers",
+                        dest="workers", type=int, default=int(conf.get('webhook-workers', '4')),
+                        help="How many deliveries to handle at the same time (default: 4)")
+    args = parser.parse_args()
+    
+    server = WebhookServer((args.listen, args.port), args.workers)
+    # reload the configuration on SIGHUP. This has to happen outside the signal handler, as it blocks.
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target = server.load).start())
+    sys.stdout.write("Listening on {}:{}\n".format(args.listen, args.port)); sys.stdout.flush()
+    server.serve_forever()